@@ -39,10 +39,14 @@ POSSIBILITY OF SUCH DAMAGE.
 
 from __future__ import print_function, unicode_literals
 
-import argparse
+import binascii
+import errno
+import io
 import logging
+import os
 import re
 import sys
+import time
 from io import open
 
 try:
@@ -51,11 +55,6 @@ except ImportError:  # pragma: no cover
     # Could happen with python < 3.3
     print("\033[31;1mError: Module ipaddress not found.\033[0m", file=sys.stderr)
     sys.exit(1)
-try:
-    from urllib.parse import urlparse
-except ImportError:  # pragma: no cover
-    # compatibility for python < 3
-    from urlparse import urlparse
 
 if sys.version_info[0] >= 3:  # pragma: no cover
     # compatibility for python < 3
@@ -69,6 +68,12 @@ __author__ = "Digitale Gesellschaft"
 
 logger = logging.getLogger(__name__)
 
+# Reserved networks keyed pseudonyms are mapped into
+PSEUDONYM_NETWORKS = {
+    4: ipaddress.ip_network("240.0.0.0/4"),
+    6: ipaddress.ip_network("2001:db8::/32"),
+}
+
 
 class Anonip(object):
     def __init__(
@@ -81,6 +86,12 @@ class Anonip(object):
         replace=None,
         regex=None,
         skip_private=False,
+        max_line_length=None,
+        log_format=None,
+        pseudonymize_key=None,
+        key_rotation=None,
+        cache_size=65536,
+        scan=False,
     ):
         """
         Main class for anonip.
@@ -91,7 +102,15 @@ class Anonip(object):
         :param increment: int
         :param delimiter: str
         :param replace: str
+        :param regex: str or compiled regex, or a list of them to try in order
         :param skip_private: bool
+        :param max_line_length: int, truncate longer lines (default: no limit)
+        :param log_format: str, Apache LogFormat or nginx log_format string
+        :param pseudonymize_key: bytes, replace addresses by keyed pseudonyms
+                                 instead of truncating them
+        :param key_rotation: None or "daily", derive a new key every day
+        :param cache_size: int, number of pseudonyms to keep cached
+        :param scan: bool, look for addresses anywhere in the line
         """
         self.columns = columns
         self._prefixes = {}  # next two lines will fill the values
@@ -102,6 +121,12 @@ class Anonip(object):
         self.replace = replace
         self.regex = regex
         self.skip_private = skip_private
+        self.max_line_length = max_line_length
+        self.log_format = log_format
+        self._pseudonym_cache = _LRUCache(cache_size)
+        self.key_rotation = key_rotation
+        self.pseudonymize_key = pseudonymize_key
+        self.scan = scan
 
     @property
     def columns(self):
@@ -112,6 +137,34 @@ class Anonip(object):
         # change columns to be 0-based
         self._columns = [c - 1 for c in columns] if columns else [0]
 
+    @property
+    def regex(self):
+        return self._regex
+
+    @regex.setter
+    def regex(self, regex):
+        self._regex = regex
+        self._regex_dispatcher = _RegexDispatcher(regex) if regex else None
+
+    @property
+    def log_format(self):
+        return self._log_format
+
+    @log_format.setter
+    def log_format(self, log_format):
+        self._log_format = log_format
+        self._log_format_parser = compile_log_format(log_format) if log_format else None
+
+    @property
+    def pseudonymize_key(self):
+        return self._pseudonymize_key
+
+    @pseudonymize_key.setter
+    def pseudonymize_key(self, key):
+        self._pseudonymize_key = key
+        self._key_day = None
+        self._hmac = None
+
     @property
     def ipv4mask(self):
         return self._ipv4mask
@@ -144,21 +197,44 @@ class Anonip(object):
             # Assign here instead of using a default parameter value
             # to allow "late binding".
             input_file = sys.stdin
-        line = input_file.readline()
+        line = self._readline(input_file)
         while line:
             line = line.rstrip()
 
             if line.strip() == "":
                 logger.debug("Empty line detected. Doing nothing.")
                 yield line
-                line = input_file.readline()
+                line = self._readline(input_file)
                 continue
 
             logger.debug("Got line: %r", line)
 
             yield self.process_line(line)
 
-            line = input_file.readline()
+            line = self._readline(input_file)
+
+    def _readline(self, input_file):
+        """
+        Read a single line, but at most `max_line_length` characters of it.
+
+        The rest of an overlong line is read in chunks of the same size and
+        dropped. That way memory usage stays bounded whatever the input is.
+
+        :param input_file: file handle to read from
+        :return: str
+        """
+        if not self.max_line_length:
+            return input_file.readline()
+        line = input_file.readline(self.max_line_length + 1)
+        if len(line) > self.max_line_length and not line.endswith("\n"):
+            logger.warning(
+                "Line exceeds %s characters, truncating it.", self.max_line_length
+            )
+            chunk = line
+            while chunk and not chunk.endswith("\n"):
+                chunk = input_file.readline(self.max_line_length)
+            line = line[: self.max_line_length]
+        return line
 
     def process_ip(self, ip):
         """
@@ -169,6 +245,8 @@ class Anonip(object):
         """
         if self.skip_private and ip[0].is_private:
             return ip[0]
+        elif self._pseudonymize_key:
+            return self.pseudonymize_address(ip)
         else:
             trunc_ip = self.truncate_address(ip)
             if self.increment:
@@ -189,7 +267,7 @@ class Anonip(object):
         :param line: str
         :return: str
         """
-        match = re.match(self.regex, line)
+        match = self._regex_dispatcher.match(line)
         if not match:
             logger.debug("Regex did not match!")
             return line
@@ -237,6 +315,130 @@ class Anonip(object):
 
         return self.delimiter.join(loglist)
 
+    def process_line_format(self, line):
+        """
+        This function processes a single line based on the provided log format.
+
+        It returns the anonymized log line as string.
+
+        :param line: str
+        :return: str
+        """
+        spans = self._log_format_parser(line)
+        if spans is None:
+            logger.debug("Log format did not match!")
+            return line
+
+        parts = []
+        pos = 0
+        for start, end, is_list in spans:
+            parts.append(line[pos:start])
+            field = line[start:end]
+            if is_list:
+                parts.append(",".join(self._process_field(f) for f in field.split(",")))
+            else:
+                parts.append(self._process_field(field))
+            pos = end
+        parts.append(line[pos:])
+        return "".join(parts)
+
+    def _process_field(self, field):
+        """
+        Anonymize the address in a field found by the log format parser.
+
+        :param field: str
+        :return: str
+        """
+        value = field.strip()
+        if value in ("", "-"):
+            return field
+        ip_str, ip = self.extract_ip(value)
+        if ip:
+            return field.replace(ip_str, str(self.process_ip(ip)))
+        elif self.replace:
+            return field.replace(value, self.replace)
+        return field
+
+    def iter_addresses(self, line):
+        """
+        Generator yielding the addresses `process_line` would anonymize.
+
+        :param line: str
+        :return: None
+        """
+        if self.scan:
+            for start, end, ip in self._scan_line(line):
+                yield line[start:end], ip
+            return
+        if self._log_format_parser:
+            fields = []
+            for start, end, is_list in self._log_format_parser(line) or []:
+                field = line[start:end]
+                fields.extend(field.split(",") if is_list else [field])
+            fields = [f.strip() for f in fields]
+            fields = [f for f in fields if f not in ("", "-")]
+        elif self.regex:
+            match = self._regex_dispatcher.match(line)
+            fields = set(match.groups()) if match else []
+        else:
+            loglist = line.split(self.delimiter)
+            fields = [loglist[i] for i in self.columns if i < len(loglist)]
+
+        for field in fields:
+            if field:
+                ip_str, ip = self.extract_ip(field)
+                if ip:
+                    yield ip_str, ip
+
+    def is_anonymized(self, ip):
+        """
+        Check whether an address looks like anonip's output.
+
+        That is, its host bits are zeroed according to the masks (and maybe
+        incremented), it is a pseudonym, or it is private and private
+        addresses are skipped.
+
+        :param ip: /32 ipaddress.IPv4Network or /128 ipaddress.IPv6Network
+        :return: bool
+        """
+        if self.skip_private and ip[0].is_private:
+            return True
+        if self._pseudonymize_key:
+            return ip[0] in PSEUDONYM_NETWORKS[ip.version]
+        return self.process_ip(ip) == ip[0]
+
+    def _scan_line(self, line):
+        """
+        Generator yielding the addresses found anywhere in the line.
+
+        :param line: str
+        :return: None
+        """
+        for match in _scan_pattern.finditer(line):
+            try:
+                ip = ipaddress.ip_network(unicode(match.group()))
+            except ValueError:
+                continue
+            yield match.start(), match.end(), ip
+
+    def process_line_scan(self, line):
+        """
+        This function processes a single line, looking for addresses anywhere.
+
+        It returns the anonymized log line as string.
+
+        :param line: str
+        :return: str
+        """
+        parts = []
+        pos = 0
+        for start, end, ip in self._scan_line(line):
+            parts.append(line[pos:start])
+            parts.append(str(self.process_ip(ip)))
+            pos = end
+        parts.append(line[pos:])
+        return "".join(parts)
+
     def process_line(self, line):
         """
         This function processes a single line.
@@ -245,8 +447,12 @@ class Anonip(object):
         :param line: str
         :return: str
         """
+        if self._log_format_parser:
+            return self.process_line_format(line)
         if self.regex:
             return self.process_line_regex(line)
+        if self.scan:
+            return self.process_line_scan(line)
         return self.process_line_column(line)
 
     @staticmethod
@@ -314,7 +520,7 @@ class Anonip(object):
                 ):
                     column = column[:-1]
 
-                parsed = urlparse("//{}".format(column))
+                parsed = _urlparse("//{}".format(column))
                 new_column = self.urlparse_hostname(parsed)
                 ip = ipaddress.ip_network(unicode(new_column))
                 return new_column, ip
@@ -331,207 +537,2457 @@ class Anonip(object):
         """
         return ip.supernet(new_prefix=self._prefixes[ip.version])[0]
 
+    def pseudonymize_address(self, ip):
+        """
+        Replace the address by a keyed pseudonym.
 
-def _validate_ipmask(mask, bits=32):
-    """
-    Verify if the supplied ip mask is valid.
+        The pseudonym is derived from an HMAC-SHA256 of the address and lies
+        within the reserved network in `PSEUDONYM_NETWORKS`. The same address
+        always gets the same pseudonym, as long as the key does not change.
 
-    :param mask: the provided ip mask
-    :param bits: 32 for ipv4, 128 for ipv6
-    :return: int
-    """
-    msg = "must be an integer between 1 and {}".format(bits)
-    try:
-        mask = int(mask)
-    except ValueError:
-        raise argparse.ArgumentTypeError(msg)
+        :param ip: ipaddress object
+        :return: ipaddress object
+        """
+        day = int(time.time() // 86400) if self.key_rotation else None
+        if self._hmac is None or day != self._key_day:
+            key = self._pseudonymize_key
+            if day is not None:
+                key = _new_hmac(key, "day:{}".format(day)).digest()
+            self._hmac = _new_hmac(key)
+            self._key_day = day
+            self._pseudonym_cache.clear()
+
+        pseudonym = self._pseudonym_cache.get(ip)
+        if pseudonym is None:
+            network = PSEUDONYM_NETWORKS[ip.version]
+            mac = self._hmac.copy()
+            mac.update(ip.network_address.packed)
+            host_bits = network.max_prefixlen - network.prefixlen
+            host = int(binascii.hexlify(mac.digest()), 16) & ((1 << host_bits) - 1)
+            pseudonym = network.network_address + host
+            self._pseudonym_cache[ip] = pseudonym
+        return pseudonym
+
+    def process_ipv4_array(self, addresses):
+        """
+        Process many IPv4 addresses at once.
 
-    if not 0 < mask <= bits:
-        raise argparse.ArgumentTypeError(msg)
+        This is the vectorized counterpart to `process_ip` and gives the same
+        results for every address. It requires numpy.
 
-    return mask
+        :param addresses: array-like of packed IPv4 addresses (uint32)
+        :return: numpy.ndarray of uint32
+        """
+        np = _import_numpy()
+        addresses = np.asarray(addresses, dtype=np.uint32)
+        host_bits = 32 - self._prefixes[4]
+        result = addresses & np.uint32((0xFFFFFFFF << host_bits) & 0xFFFFFFFF)
+
+        private = None
+        if self.skip_private:
+            private = _private_ipv4_array(np, addresses)
+
+        if self._pseudonymize_key:
+            unique, inverse = np.unique(addresses, return_inverse=True)
+            pseudonyms = self._pseudonyms((int(a) for a in unique), 4)
+            result = np.array(pseudonyms, dtype=np.uint32)[inverse]
+            result = result.reshape(addresses.shape)
+        elif self.increment:
+            if self.increment <= 0xFFFFFFFF:
+                incremented = result.astype(np.uint64) + np.uint64(self.increment)
+                overflow = incremented > 0xFFFFFFFF
+                result = np.where(overflow, result, incremented.astype(np.uint32))
+            else:
+                overflow = np.ones(addresses.shape, dtype=bool)
+            self._log_increment_overflow(np, overflow, private)
 
+        if private is not None:
+            result = np.where(private, addresses, result)
+        return result
 
-def _validate_integer_ht_0(value):
+    def process_ipv6_array(self, high, low):
+        """
+        Process many IPv6 addresses at once.
+
+        This is the vectorized counterpart to `process_ip` and gives the same
+        results for every address. It requires numpy.
+
+        :param high: array-like of the upper 64 bits (uint64)
+        :param low: array-like of the lower 64 bits (uint64)
+        :return: tuple (numpy.ndarray of uint64, numpy.ndarray of uint64)
+        """
+        np = _import_numpy()
+        high = np.asarray(high, dtype=np.uint64)
+        low = np.asarray(low, dtype=np.uint64)
+        host_bits = 128 - self._prefixes[6]
+        netmask = ((1 << 128) - 1) ^ ((1 << host_bits) - 1)
+        result_high = high & np.uint64(netmask >> 64)
+        result_low = low & np.uint64(netmask & 0xFFFFFFFFFFFFFFFF)
+
+        private = None
+        if self.skip_private:
+            private = _private_ipv6_array(np, high, low)
+
+        if self._pseudonymize_key:
+            result_high, result_low = self._pseudonymize_ipv6_array(np, high, low)
+        elif self.increment:
+            if self.increment < 1 << 128:
+                increment_high = np.uint64(self.increment >> 64)
+                increment_low = np.uint64(self.increment & 0xFFFFFFFFFFFFFFFF)
+                # uint64 arithmetic wraps around, a smaller sum means a carry
+                new_low = result_low + increment_low
+                carry = (new_low < result_low).astype(np.uint64)
+                new_high = result_high + increment_high
+                overflow = new_high < result_high
+                new_high_carried = new_high + carry
+                overflow |= new_high_carried < new_high
+                result_high = np.where(overflow, result_high, new_high_carried)
+                result_low = np.where(overflow, result_low, new_low)
+            else:
+                overflow = np.ones(high.shape, dtype=bool)
+            self._log_increment_overflow(np, overflow, private)
+
+        if private is not None:
+            result_high = np.where(private, high, result_high)
+            result_low = np.where(private, low, result_low)
+        return result_high, result_low
+
+    def _pseudonymize_ipv6_array(self, np, high, low):
+        """
+        :param np: numpy module
+        :param high: numpy.ndarray of uint64, the upper 64 bits
+        :param low: numpy.ndarray of uint64, the lower 64 bits
+        :return: tuple (numpy.ndarray of uint64, numpy.ndarray of uint64)
+        """
+        pairs = np.stack([high.ravel(), low.ravel()], axis=1)
+        unique, inverse = np.unique(pairs, axis=0, return_inverse=True)
+        pseudonyms = self._pseudonyms(
+            (int(upper) << 64 | int(lower) for upper, lower in unique), 6
+        )
+        inverse = inverse.ravel()
+        result_high = np.array([p >> 64 for p in pseudonyms], dtype=np.uint64)
+        result_low = np.array(
+            [p & 0xFFFFFFFFFFFFFFFF for p in pseudonyms], dtype=np.uint64
+        )
+        return (
+            result_high[inverse].reshape(high.shape),
+            result_low[inverse].reshape(low.shape),
+        )
+
+    def _pseudonyms(self, addresses, version):
+        """
+        Pseudonymize addresses one by one, as the HMAC can't be vectorized.
+        The array functions pass each distinct address only once.
+
+        :param addresses: iterable of int
+        :param version: int, 4 or 6
+        :return: list of int
+        """
+        network = ipaddress.IPv4Network if version == 4 else ipaddress.IPv6Network
+        return [int(self.pseudonymize_address(network(a))) for a in addresses]
+
+    def _log_increment_overflow(self, np, overflow, private):
+        if private is not None:
+            overflow = overflow & ~private
+        count = int(np.count_nonzero(overflow))
+        if count:
+            logger.error("Could not increment %s IPs by %s", count, self.increment)
+
+
+def _urlparse(url):
     """
-    Validate if given string is a number higher than 0.
+    Call `urllib.parse.urlparse`, importing it on first use.
 
-    :param value: str or int
-    :return: int
+    The import is deferred to keep the startup of the CLI fast, as only
+    columns with a port or brackets need it.
+
+    :param url: str
+    :return: urllib.parse.ParseResult
     """
-    msg = "must be a positive integer"
     try:
-        value = int(value)
-    except ValueError:
-        raise argparse.ArgumentTypeError(msg)
-    if not value >= 1:
-        raise argparse.ArgumentTypeError(msg)
-    return value
+        from urllib.parse import urlparse
+    except ImportError:  # pragma: no cover
+        # compatibility for python < 3
+        from urlparse import urlparse
+    return urlparse(url)
+
+
+# Apache LogFormat directives and nginx variables holding client addresses,
+# mapped to whether they can hold a comma separated list of addresses.
+_LOG_FORMAT_IP_FIELDS = {
+    "%h": False,
+    "%a": False,
+    "%{c}a": False,
+    "%{x-forwarded-for}i": True,
+    "$remote_addr": False,
+    "$realip_remote_addr": False,
+    "$http_x_forwarded_for": True,
+    "$proxy_add_x_forwarded_for": True,
+}
+
+LOG_FORMAT_NICKNAMES = {
+    "common": '%h %l %u %t "%r" %>s %b',
+    "combined": '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-agent}i"',
+}
+
+_log_format_token = re.compile(
+    r"%%|%[!\d,]*[<>]?(?:\{[^}]*\})?[<>]?[a-zA-Z]|\$[a-zA-Z_][a-zA-Z0-9_]*"
+)
+_log_format_cache = {}
+
+# Directives whose values can hold spaces or any other separator, e.g. the
+# request line, custom time formats and headers
+_log_format_free_text = re.compile(
+    r"(?:%[!\d,]*[<>]?(?:\{[^}]*\}[<>]?[tieonC]|r|f)"
+    r"|\$(?:request|request_body|time_local|(?:http|sent_http|cookie|arg)_\w+))\Z"
+)
+
+
+# Candidates for IPv6 and IPv4 addresses, e.g. for scanning free text. They may
+# follow ":" or "=" ("client:1.2.3.4") and be followed by the period ending a
+# sentence, but must not be part of a longer dotted number.
+_scan_pattern = re.compile(
+    r"(?<![\w.])(?:"
+    r"(?:[0-9a-fA-F]{0,4}:){2,7}(?:[0-9a-fA-F]{1,4}|\d{1,3}(?:\.\d{1,3}){3})?"
+    r"(?![\w:]|\.\d)"
+    r"|(?:\d{1,3}\.){3}\d{1,3}(?!\w|\.\d)"
+    r")"
+)
+
+
+def compile_log_format(log_format):
+    """
+    Compile a log format string into a parser for matching log lines.
 
+    Accepts Apache LogFormat strings (e.g. '%h %l %u %t "%r" %>s %b'), nginx
+    log_format strings (e.g. '$remote_addr - $remote_user [$time_local] ...')
+    and the nicknames "common" and "combined".
 
-def regex_arg_type(value):
+    Parsers are cached per format string.
+
+    :param log_format: str
+    :return: callable, see `_LogFormatParser`
+    """
     try:
-        re.compile(value)
-    except re.error as e:
-        msg = "must be a valid regex."
-        if hasattr(e, "msg"):  # pragma: no cover
-            # not available on py27
-            msg = "must be a valid regex. Error: {}".format(e.msg)
-        raise argparse.ArgumentTypeError(msg)
-    return value
+        return _log_format_cache[log_format]
+    except KeyError:
+        parser = _LogFormatParser(LOG_FORMAT_NICKNAMES.get(log_format, log_format))
+        _log_format_cache[log_format] = parser
+        return parser
 
 
-def parse_arguments(args):
+def _find_closing_quote(line, pos):
     """
-    Parse all given arguments.
+    Find the next double quote which is not escaped by a backslash.
 
-    :param args: list
-    :return: argparse.Namespace
+    :param line: str
+    :param pos: int, position to start searching from
+    :return: int, -1 if not found
     """
-    parser = argparse.ArgumentParser(
-        description=__description__,
-        epilog="Example-usage in apache-config:\n"
-        'CustomLog "| /path/to/anonip.py '
-        '[OPTIONS] --output /path/to/log" '
-        "combined\n ",
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-    )
+    end = line.find('"', pos)
+    while end > pos:
+        backslashes = 0
+        while line[end - 1 - backslashes] == "\\":
+            backslashes += 1
+        if backslashes % 2 == 0:
+            break
+        end = line.find('"', end + 1)
+    return end
+
+
+class _LogFormatParser(object):
+    """
+    Parser for log lines of a specific log format.
 
-    parser.add_argument(
-        "-4",
-        "--ipv4mask",
-        metavar="INTEGER",
-        help="truncate the last n bits (default: %(default)s)",
-        type=lambda x: _validate_ipmask(x, 32),
-    )
-    parser.set_defaults(ipv4mask=12)
-    parser.add_argument(
-        "-6",
-        "--ipv6mask",
-        type=lambda x: _validate_ipmask(x, 128),
-        metavar="INTEGER",
-        help="truncate the last n bits (default: %(default)s)",
-    )
-    parser.set_defaults(ipv6mask=84)
-    parser.add_argument(
-        "-i",
-        "--increment",
-        metavar="INTEGER",
-        type=lambda x: _validate_integer_ht_0(x),
-        help="increment the IP address by n (default: %(default)s)",
-    )
-    parser.set_defaults(increment=0)
-    parser.add_argument("-o", "--output", metavar="FILE", help="file to write to")
-    parser.add_argument(
-        "--input", metavar="FILE", help="File or FIFO to read from (default: stdin)"
-    )
-    parser.add_argument(
-        "-c",
-        "--column",
-        metavar="INTEGER",
-        dest="columns",
-        nargs="+",
-        type=lambda x: _validate_integer_ht_0(x),
-        help="assume IP address is in column n (1-based indexed; default: 1)",
-    )
-    parser.add_argument(
-        "-l",
-        "--delimiter",
-        metavar="STRING",
-        type=str,
-        help='log delimiter (default: " ")',
-    )
-    parser.add_argument(
-        "--regex",
-        metavar="STRING",
-        nargs="+",
-        help="regex for detecting IP addresses (use optionally instead of -c)",
-        type=regex_arg_type,
-    )
-    parser.add_argument(
-        "-r",
-        "--replace",
-        metavar="STRING",
-        help="replacement string in case address parsing fails (Example: 0.0.0.0)",
-    )
-    parser.add_argument(
-        "-p",
-        "--skip-private",
-        dest="skip_private",
-        action="store_true",
-        help="do not mask addresses in private ranges. "
-        "See IANA Special-Purpose Address Registry.",
-    )
-    parser.add_argument(
-        "-d", "--debug", action="store_true", help="print debug messages"
-    )
-    parser.add_argument("-v", "--version", action="version", version=__version__)
+    Called with a line, it returns a list of (start, end, is_list) tuples
+    giving the position of the fields holding IP addresses, or None if the
+    line does not match the log format. Only the fields up to the last
+    address field are looked at.
+    """
 
-    args = parser.parse_args(args)
+    def __init__(self, log_format):
+        """
+        :param log_format: str, Apache LogFormat or nginx log_format string
+        """
+        literals = []
+        fields = []
+        pos = 0
+        for match in _log_format_token.finditer(log_format):
+            token = match.group()
+            if token == "%%":
+                continue
+            literals.append(log_format[pos : match.start()].replace("%%", "%"))
+            fields.append(token)
+            pos = match.end()
+        literals.append(log_format[pos:].replace("%%", "%"))
+
+        ip_fields = [
+            i for i, f in enumerate(fields) if f.lower() in _LOG_FORMAT_IP_FIELDS
+        ]
+        if not ip_fields:
+            raise ValueError("log format contains no IP address field")
+
+        # one step per field: (literal before it, function finding its end,
+        # whether it is an address list or None if it holds no address)
+        self._steps = []
+        for i, field in enumerate(fields[: ip_fields[-1] + 1]):
+            before, after = literals[i], literals[i + 1]
+            if field == "%t":
+                # "[10/Oct/2000:13:55:36 -0700]", includes the brackets
+                find_end = self._find_bracket_end
+            elif before.endswith('"') and after.startswith('"'):
+                find_end = _find_closing_quote
+            elif after:
+                self._check_enclosed(field, before, after)
+                find_end = self._literal_finder(after)
+            elif i == len(fields) - 1:
+                find_end = self._find_line_end
+            else:
+                raise ValueError(
+                    "field {} must be followed by a separator".format(field)
+                )
+            self._steps.append(
+                (before, find_end, _LOG_FORMAT_IP_FIELDS.get(field.lower()))
+            )
 
-    if args.regex and (args.columns is not None or args.delimiter is not None):
-        raise parser.error(
-            'Ambiguous arguments: When using "--regex", "-c" and "-l" can\'t be used.'
-        )
-    if not args.regex and args.columns is None:
-        args.columns = [1]
-    if not args.regex and args.delimiter is None:
-        args.delimiter = " "
-    if args.regex:
-        try:
-            args.regex = re.compile(r"|".join(args.regex))
-        except re.error:  # pragma: no cover
-            raise argparse.ArgumentTypeError("Failed to compile concatenated regex!")
+    @staticmethod
+    def _check_enclosed(field, before, after):
+        """
+        Make sure a field ended by a separator can't hold the separator.
 
-    return args
+        Otherwise e.g. "%{%d/%b/%Y %T}t %h" would take the time for the
+        address, and leave the address unmasked.
+        """
+        enclosed = before.endswith("[") and after.startswith("]")
+        if _log_format_free_text.match(field) and not enclosed:
+            raise ValueError(
+                "field {} can contain the separator {!r}, it must be enclosed "
+                "in quotes or brackets".format(field, after)
+            )
 
+    @staticmethod
+    def _literal_finder(literal):
+        return lambda line, pos: line.find(literal, pos)
 
-def main():
+    @staticmethod
+    def _find_bracket_end(line, pos):
+        end = line.find("]", pos)
+        return end + 1 if end >= 0 else end
+
+    @staticmethod
+    def _find_line_end(line, pos):
+        return len(line)
+
+    def __call__(self, line):
+        spans = []
+        pos = 0
+        for before, find_end, is_list in self._steps:
+            if not line.startswith(before, pos):
+                return None
+            pos += len(before)
+            end = find_end(line, pos)
+            if end < 0:
+                return None
+            if is_list is not None:
+                spans.append((pos, end, is_list))
+            pos = end
+        return spans
+
+
+def _flatten_regex(items, sre_parse):
     """
-    Main CLI function for anonip.
+    Inline the groups of a parsed regex, as far as they match case-sensitive.
     """
-    args = parse_arguments(sys.argv[1:])
+    for op, av in items:
+        # av is (group, add_flags, del_flags, pattern), (group, pattern) on py27
+        if op == sre_parse.SUBPATTERN and not (len(av) == 4 and av[1] & re.IGNORECASE):
+            for item in _flatten_regex(av[-1], sre_parse):
+                yield item
+        else:
+            yield op, av
 
-    logging.basicConfig()
-    if args.debug:
-        logger.level = logging.DEBUG
-    else:
-        logger.level = logging.WARNING
 
-    anonip = Anonip(
-        args.columns,
-        args.ipv4mask,
-        args.ipv6mask,
-        args.increment,
-        args.delimiter,
-        args.replace,
-        args.regex,
-        args.skip_private,
-    )
+def _regex_literals(pattern):
+    """
+    Find literal text every match of a regex contains.
 
-    input_file = output_file = None
+    :param pattern: compiled regex
+    :return: tuple (str, the literal text a match starts with; str, the
+             longest literal text in a match)
+    """
     try:
-        if args.input:
-            input_file = open(args.input, "r")
-        if args.output:
-            output_file = open(args.output, "a")
-        else:
-            output_file = sys.stdout
-        for line in anonip.run(input_file):
-            print(unicode(line), file=output_file)
-            # TODO: when dropping support for Python <= 3.3, move the
-            # flush into the print()
-            output_file.flush()
-    except IOError as err:  # pragma: no cover
-        logger.error(err)
-    except KeyboardInterrupt:  # pragma: no cover
-        pass
-    finally:
-        if args.input and input_file:
-            input_file.close()
-        if args.output and output_file:
-            output_file.close()
+        from re import _parser as sre_parse
+    except ImportError:  # pragma: no cover
+        # compatibility for python < 3.11
+        import sre_parse
+
+    if pattern.flags & re.IGNORECASE:
+        return "", ""
+    runs = [""]
+    for op, av in _flatten_regex(
+        sre_parse.parse(pattern.pattern, pattern.flags), sre_parse
+    ):
+        if op == sre_parse.LITERAL:
+            runs[-1] += "%c" % av
+        elif op != sre_parse.AT:
+            # anything else than anchors ends the literal text
+            runs.append("")
+    return runs[0], max(runs, key=len)
+
+
+class _RegexDispatcher(object):
+    """
+    Matcher for a list of regexes, trying them in order.
+
+    Unlike one alternation of all regexes, each line is only matched against
+    the regexes which can match it: those whose literal prefix the line starts
+    with and whose longest literal text it contains. The regexes are grouped
+    by the start of their prefix, so most of them are skipped with a single
+    dict lookup.
+    """
+
+    def __init__(self, regexes):
+        """
+        :param regexes: str or compiled regex, or a list of them
+        """
+        if not isinstance(regexes, (list, tuple)):
+            regexes = [regexes]
+        candidates = []
+        for regex in regexes:
+            regex = re.compile(regex)
+            prefix, literal = _regex_literals(regex)
+            candidates.append((prefix, literal, regex))
+        self._any_start = [c for c in candidates if not c[0]]
+        # the regexes are grouped by the start of their prefixes, as long as
+        # all prefixes are
+        self._key_length = min([len(c[0]) for c in candidates if c[0]] or [0])
+        self._by_start = {}
+        for key in set(c[0][: self._key_length] for c in candidates if c[0]):
+            self._by_start[key] = [
+                c for c in candidates if not c[0] or c[0].startswith(key)
+            ]
+
+    def match(self, line):
+        """
+        Match a line against the first regex matching it.
+
+        :param line: str
+        :return: match object or None
+        """
+        key = line[: self._key_length]
+        for prefix, literal, regex in self._by_start.get(key, self._any_start):
+            if line.startswith(prefix) and literal in line:
+                match = regex.match(line)
+                if match:
+                    return match
+        return None
+
+
+# Share of the sampled lines an engine must handle to be chosen by --auto
+_AUTO_THRESHOLD = 0.9
+
+_DELIMITER_NAMES = {
+    " ": "space",
+    ",": "comma",
+    ";": "semicolon",
+    "\t": "tab",
+    "|": "pipe",
+}
+
+_quoted_field = r'"(?:[^"\\]|\\.)*"'
+_common_pattern = re.compile(
+    r"^\S+ \S+ \S+ \[[^\]]+\] " + _quoted_field + r" \d{3} (?:\d+|-)"
+)
+_combined_pattern = re.compile(
+    _common_pattern.pattern + " " + _quoted_field + " " + _quoted_field
+)
+
+
+def _is_ip(value):
+    """
+    Check whether a string is an IP address.
+
+    :param value: str
+    :return: bool
+    """
+    try:
+        ipaddress.ip_network(unicode(value))
+    except ValueError:
+        return False
+    return True
+
+
+def _count(values):
+    return sum(1 for v in values if v)
+
+
+def _log_format_candidates(lines, needed):
+    """
+    :param lines: list of str
+    :param needed: number of lines an engine must handle
+    :return: list of tuples (description, dict of `Anonip` attributes)
+    """
+    for name, pattern in (("combined", _combined_pattern), ("common", _common_pattern)):
+        matches = (
+            pattern.match(line) and _is_ip(line.split(" ", 1)[0]) for line in lines
+        )
+        if _count(matches) >= needed:
+            return [("{} log format".format(name), {"log_format": name})]
+    return []
+
+
+def _json_candidates(lines, needed):
+    """
+    :param lines: list of str
+    :param needed: number of lines an engine must handle
+    :return: list of tuples (description, dict of `Anonip` attributes)
+    """
+    import json
+
+    objects = []
+    for line in lines:
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(obj, dict):
+            objects.append(obj)
+    if len(objects) < needed:
+        return []
+    keys = sorted(
+        set(k for o in objects for k, v in o.items() if isinstance(v, unicode))
+    )
+    counts = [
+        _count(isinstance(o.get(k), unicode) and _is_ip(o[k]) for o in objects)
+        for k in keys
+    ]
+    if not counts or max(counts) < needed:
+        return []
+    # every field ever holding an address, not to miss the rare ones
+    keys = [k for k, count in zip(keys, counts) if count]
+    # a lookahead per field, so the fields can be in any order
+    regex = "".join(
+        r'(?:(?=.*?"{}"\s*:\s*"([^"]*)"))?'.format(re.escape(json.dumps(k)[1:-1]))
+        for k in keys
+    )
+    return [("JSON lines, fields " + ", ".join(keys), {"regex": re.compile(regex)})]
+
+
+def _column_candidates(lines, needed):
+    """
+    :param lines: list of str
+    :param needed: number of lines an engine must handle
+    :return: list of tuples (description, dict of `Anonip` attributes)
+    """
+    candidates = []
+    for delimiter, name in sorted(_DELIMITER_NAMES.items()):
+        rows = [line.split(delimiter) for line in lines]
+        width = max(len(row) for row in rows)
+        counts = [
+            _count(i < len(row) and _is_ip(row[i]) for row in rows)
+            for i in range(width)
+        ]
+        # every column ever holding an address, not to miss the rare ones
+        columns = [i + 1 for i, count in enumerate(counts) if count]
+        # a single column is the same for all delimiters
+        if max(counts) >= needed and (width > 1 or delimiter == " "):
+            candidates.append(
+                (
+                    "{} separated, columns {}".format(
+                        name, ", ".join(str(c) for c in columns)
+                    ),
+                    {"columns": columns, "delimiter": delimiter},
+                )
+            )
+    return candidates
+
+
+def _engine_candidates(lines):
+    """
+    Find the engine settings able to process the sampled lines.
+
+    :param lines: list of str, without empty lines
+    :return: list of tuples (description, dict of `Anonip` attributes)
+    """
+    needed = len(lines) * _AUTO_THRESHOLD
+    return (
+        _log_format_candidates(lines, needed)
+        + _json_candidates(lines, needed)
+        + _column_candidates(lines, needed)
+    )
+
+
+def _found_addresses(anonip, lines):
+    """
+    :param anonip: Anonip
+    :param lines: list of str
+    :return: list of the sorted addresses found per line
+    """
+    return [
+        sorted((ip.version, ip) for _, ip in anonip.iter_addresses(line))
+        for line in lines
+    ]
+
+
+def _covering_candidates(anonip, lines):
+    """
+    Find the engine settings finding every address scanning finds.
+
+    An engine missing any address of the sample would leak it, however
+    fast it is. If none is left, the lines are scanned.
+
+    :param anonip: Anonip
+    :param lines: list of str, without empty lines
+    :return: list of tuples (description, dict of `Anonip` attributes)
+    """
+    scan = ("free text", {"scan": True})
+    _configure_engine(anonip, scan[1])
+    expected = _found_addresses(anonip, lines)
+    candidates = []
+    for description, settings in _engine_candidates(lines):
+        _configure_engine(anonip, settings)
+        if _found_addresses(anonip, lines) == expected:
+            candidates.append((description, settings))
+    return candidates or [scan]
+
+
+def _configure_engine(anonip, settings):
+    """
+    Switch an `Anonip` instance to another engine.
+
+    :param anonip: Anonip
+    :param settings: dict of `Anonip` attributes
+    :return: None
+    """
+    anonip.log_format = None
+    anonip.regex = None
+    anonip.scan = False
+    anonip.columns = None
+    anonip.delimiter = " "
+    for name, value in settings.items():
+        setattr(anonip, name, value)
+
+
+def autodetect(anonip, lines):
+    """
+    Detect the format of the sample lines and configure `anonip` for it.
+
+    Of all engines able to process the lines (a log format, a regex for JSON
+    fields, columns or scanning free text), the one processing the sample
+    fastest is chosen. Only engines finding every address scanning finds on
+    the sample are considered, and scanning is used if nothing else fits.
+
+    :param anonip: Anonip
+    :param lines: list of str
+    :return: tuple (description of the format, expected lines per second) or
+             (None, None) if there are no lines
+    """
+    lines = [line.rstrip() for line in lines if line.strip()]
+    if not lines:
+        logger.info("No lines to detect the format from, using the defaults.")
+        return None, None
+
+    timer = getattr(time, "perf_counter", time.time)
+    best = None
+    disabled = logger.disabled
+    # don't warn about the lines an engine can't handle
+    logger.disabled = True
+    try:
+        for description, settings in _covering_candidates(anonip, lines):
+            _configure_engine(anonip, settings)
+            elapsed = []
+            for _ in range(3):
+                start = timer()
+                for line in lines:
+                    anonip.process_line(line)
+                elapsed.append(timer() - start)
+            if best is None or min(elapsed) < best[0]:
+                best = (min(elapsed), description, settings)
+    finally:
+        logger.disabled = disabled
+
+    elapsed, description, settings = best
+    _configure_engine(anonip, settings)
+    rate = len(lines) / elapsed if elapsed else float("inf")
+    logger.info("Detected %s, expecting about %.0f lines/s.", description, rate)
+    return description, rate
+
+
+class _PrefixedFile(object):
+    """
+    File handle returning some lines read before, then reading on.
+    """
+
+    def __init__(self, lines, input_file, reader=None):
+        """
+        :param lines: list of str, the lines to return first
+        :param input_file: file handle to read from afterwards
+        :param reader: thread or None, still appending a line to `lines`
+        """
+        self._lines = lines
+        self._pos = 0
+        self._input_file = input_file
+        self._reader = reader
+
+    def readline(self, size=-1):
+        if self._pos == len(self._lines) and self._reader:
+            # wait for the line the reader is still reading
+            self._reader.join()
+            self._reader = None
+        if self._pos == len(self._lines):
+            return self._input_file.readline(size)
+        line = self._lines[self._pos]
+        if 0 <= size < len(line):
+            self._lines[self._pos] = line[size:]
+            return line[:size]
+        self._pos += 1
+        return line
+
+    def close(self):
+        self._input_file.close()
+
+
+def _new_hmac(key, msg=None):
+    """
+    Create an HMAC-SHA256 object, importing hmac and hashlib on first use.
+
+    :param key: bytes
+    :param msg: str or None
+    :return: hmac.HMAC
+    """
+    import hashlib
+    import hmac
+
+    return hmac.new(key, msg and msg.encode("utf-8"), hashlib.sha256)
+
+
+class _LRUCache(object):
+    """
+    Mapping keeping only the `maxsize` most recently used entries.
+    """
+
+    def __init__(self, maxsize):
+        """
+        :param maxsize: int, 0 disables the cache
+        """
+        from collections import OrderedDict
+
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return None
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+def _import_numpy():
+    """
+    Import numpy, which is only needed for the array functions.
+
+    :return: module
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError(
+            "numpy is required for processing arrays; "
+            'install it with "pip install anonip[numpy]"'
+        )
+    return numpy
+
+
+_private_networks_cache = {}
+
+
+def _private_networks(version):
+    """
+    Fetch the networks `is_private` uses to classify addresses.
+
+    Reading them from the ipaddress module keeps the array functions in line
+    with the scalar path on every python version.
+
+    :param version: 4 or 6
+    :return: tuple (list of networks, list of exempted networks) or None if
+             the ipaddress module does not expose them
+    """
+    if version not in _private_networks_cache:
+        address_class = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+        constants = getattr(address_class, "_constants", None)
+        networks = getattr(constants, "_private_networks", None)
+        if networks is None:  # pragma: no cover
+            # ipaddress backport for python < 3.3
+            _private_networks_cache[version] = None
+        else:
+            exceptions = getattr(constants, "_private_networks_exceptions", [])
+            _private_networks_cache[version] = (networks, exceptions)
+    return _private_networks_cache[version]
+
+
+def _match_ipv4_array(np, addresses, networks):
+    matches = np.zeros(addresses.shape, dtype=bool)
+    for net in networks:
+        netmask = np.uint32(int(net.netmask))
+        matches |= (addresses & netmask) == np.uint32(int(net.network_address))
+    return matches
+
+
+def _match_ipv6_array(np, high, low, networks):
+    matches = np.zeros(high.shape, dtype=bool)
+    for net in networks:
+        netmask = int(net.netmask)
+        address = int(net.network_address)
+        matches |= ((high & np.uint64(netmask >> 64)) == np.uint64(address >> 64)) & (
+            (low & np.uint64(netmask & 0xFFFFFFFFFFFFFFFF))
+            == np.uint64(address & 0xFFFFFFFFFFFFFFFF)
+        )
+    return matches
+
+
+def _private_ipv4_array(np, addresses):
+    """
+    Vectorized `ipaddress.IPv4Address.is_private`.
+
+    :return: numpy.ndarray of bool
+    """
+    networks = _private_networks(4)
+    if networks is None:  # pragma: no cover
+        return np.array(
+            [ipaddress.IPv4Address(int(a)).is_private for a in addresses.flat],
+            dtype=bool,
+        ).reshape(addresses.shape)
+    private = _match_ipv4_array(np, addresses, networks[0])
+    if networks[1]:  # pragma: no cover
+        # only newer python versions define exceptions
+        private &= ~_match_ipv4_array(np, addresses, networks[1])
+    return private
+
+
+def _private_ipv6_array(np, high, low):
+    """
+    Vectorized `ipaddress.IPv6Address.is_private`.
+
+    :return: numpy.ndarray of bool
+    """
+    networks = _private_networks(6)
+    if networks is None:  # pragma: no cover
+        return np.array(
+            [
+                ipaddress.IPv6Address(int(upper) << 64 | int(lower)).is_private
+                for upper, lower in zip(high.flat, low.flat)
+            ],
+            dtype=bool,
+        ).reshape(high.shape)
+    private = _match_ipv6_array(np, high, low, networks[0])
+    if networks[1]:  # pragma: no cover
+        # only newer python versions define exceptions
+        private &= ~_match_ipv6_array(np, high, low, networks[1])
+    if not ipaddress.IPv6Address("::ffff:808:808").is_private:  # pragma: no cover
+        # newer python versions classify ipv4-mapped addresses as ipv4
+        mapped = (high == 0) & ((low >> np.uint64(32)) == 0xFFFF)
+        mapped_private = _private_ipv4_array(
+            np, (low & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+        )
+        private = np.where(mapped, mapped_private, private)
+    return private
+
+
+class _QueuedWriter(object):
+    """
+    Write lines to a file from a separate thread.
+
+    Lines are handed to the writer thread through a bounded queue, so a slow
+    output does not stop the reading of the input right away. `policy` decides
+    what happens once the queue is full:
+
+     - "block": wait until the writer thread catches up
+     - "spill": buffer the lines in a temporary file
+     - "drop": discard the lines and count them
+    """
+
+    def __init__(self, output_file, maxsize, policy="block", batch_size=1024):
+        """
+        :param output_file: file handle to write to
+        :param maxsize: int, maximum number of lines in the queue
+        :param policy: str, "block", "spill" or "drop"
+        :param batch_size: int, maximum number of lines written at once
+        """
+        import threading
+
+        try:
+            import queue
+        except ImportError:  # pragma: no cover
+            # compatibility for python < 3
+            import Queue as queue
+
+        self._output_file = output_file
+        self._queue = queue.Queue(maxsize)
+        self._queue_empty = queue.Empty
+        self._queue_full = queue.Full
+        self._policy = policy
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._spill_file = None
+        self._error = None
+        self.max_depth = 0
+        self.spilled = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._consume, name="anonip-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """
+        Number of lines waiting in the queue.
+        """
+        return self._queue.qsize()
+
+    def write_line(self, line):
+        """
+        Queue a line for writing.
+
+        :param line: str, without the line break
+        :return: None
+        """
+        if self._error:
+            raise self._error
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+        if self._policy == "block":
+            self._queue.put(line)
+            return
+        if self._spill_file:
+            with self._lock:
+                # lines must keep spilling until the writer took the
+                # buffered ones, to keep the order
+                if self._spill_file:  # pragma: no branch
+                    self._spill(line)
+                    return
+        try:
+            self._queue.put_nowait(line)
+        except self._queue_full:
+            if self._policy == "drop":
+                self.dropped += 1
+                logger.debug("Writer queue is full. Dropping line.")
+            else:
+                self._queue_or_spill(line)
+
+    def _queue_or_spill(self, line):
+        with self._lock:
+            # the writer may have emptied the queue in the meantime, and be
+            # waiting for lines already: spill only while the queue is still
+            # full, as then the writer is bound to look for the spill file
+            # once it took the queued lines
+            if not self._spill_file:  # pragma: no branch
+                try:
+                    self._queue.put_nowait(line)
+                    return
+                except self._queue_full:
+                    pass
+            self._spill(line)
+
+    def close(self):
+        """
+        Write all queued lines and stop the writer thread.
+
+        :return: None
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self.log_stats()
+        if self.dropped:
+            logger.warning(
+                "Dropped %s lines because the writer queue was full.", self.dropped
+            )
+        if self._error:
+            raise self._error
+
+    def log_stats(self, level=logging.DEBUG):
+        """
+        Log the current and maximum queue depth and the spilled and dropped
+        lines.
+
+        :param level: int, logging level
+        :return: None
+        """
+        logger.log(
+            level,
+            "Writer queue: depth %s, maximum depth %s, %s lines spilled, "
+            "%s lines dropped",
+            self.depth,
+            self.max_depth,
+            self.spilled,
+            self.dropped,
+        )
+
+    def _spill(self, line):
+        if not self._spill_file:
+            import tempfile
+
+            fd, name = tempfile.mkstemp(prefix="anonip-spill-")
+            self._spill_file = open(fd, "w+", encoding="utf-8")
+            os.remove(name)
+        self._spill_file.write(line + "\n")
+        self.spilled += 1
+
+    def _unspill(self):
+        """
+        Copy the spilled lines to the output.
+
+        Spilled lines are newer than the queued ones: while the producer
+        refilled the queue in the meantime, these are written first.
+        """
+        with self._lock:
+            if not self._queue.empty():
+                return
+            spill_file, self._spill_file = self._spill_file, None
+        if not spill_file:
+            return
+        spill_file.seek(0)
+        for chunk in iter(lambda: spill_file.read(65536), ""):
+            self._output_file.write(chunk)
+        spill_file.close()
+        self._output_file.flush()
+
+    def _write(self, lines):
+        if lines:
+            self._output_file.write("\n".join(lines) + "\n")
+            self._output_file.flush()
+
+    def _consume(self):
+        """
+        Main loop of the writer thread.
+        """
+        closed = False
+        while not closed:
+            try:
+                line = self._queue.get_nowait()
+            except self._queue_empty:
+                self._guarded(self._unspill)
+                line = self._queue.get()
+            lines = [line]
+            while line is not None and len(lines) < self._batch_size:
+                try:
+                    line = self._queue.get_nowait()
+                except self._queue_empty:
+                    break
+                lines.append(line)
+            closed = lines[-1] is None
+            if closed:
+                lines.pop()
+            self._guarded(self._write, lines)
+        self._guarded(self._unspill)
+
+    def _guarded(self, func, *args):
+        try:
+            func(*args)
+        except EnvironmentError as err:
+            # keep on emptying the queue, so write_line() does not block
+            # forever, and report the error from there
+            self._error = err
+
+
+# Number of offending lines listed per file by the audit
+_AUDIT_SAMPLES = 10
+
+# Anonip instance used by the worker processes
+_worker_anonip = None
+
+
+def _init_worker(kwargs):
+    """
+    Initialize a worker process.
+
+    :param kwargs: dict, arguments for `Anonip`
+    :return: None
+    """
+    global _worker_anonip
+    _worker_anonip = Anonip(**kwargs)
+
+
+def _audit_file(path):
+    """
+    Check that all addresses in a file are anonymized.
+
+    :param path: str
+    :return: dict with the counts and samples of offending lines, and the
+             error message if the file couldn't be read completely
+    """
+    result = {
+        "path": path,
+        "lines": 0,
+        "addresses": 0,
+        "unmasked": 0,
+        "samples": [],
+        "error": None,
+    }
+    try:
+        with _open_log(path) as f:
+            lines = iter(lambda: _worker_anonip._readline(f), "")
+            for lineno, line in enumerate(lines, 1):
+                result["lines"] = lineno
+                for ip_str, ip in _worker_anonip.iter_addresses(line.rstrip()):
+                    result["addresses"] += 1
+                    if not _worker_anonip.is_anonymized(ip):
+                        result["unmasked"] += 1
+                        if len(result["samples"]) < _AUDIT_SAMPLES:
+                            result["samples"].append((lineno, ip_str))
+    except Exception as err:
+        # e.g. a missing file or EOFError for truncated gzip files: report
+        # the file, but carry on with the others
+        result["error"] = str(err) or type(err).__name__
+    return result
+
+
+def _map_files(func, paths, kwargs, jobs):
+    """
+    Call `func` for each file in a pool of worker processes.
+
+    :param func: function taking the path, run in the worker processes
+    :param paths: list of str
+    :param kwargs: dict, arguments for `Anonip` in the worker processes
+    :param jobs: int or None, number of processes (default: number of CPUs)
+    :return: iterator over the results, in order
+    """
+    import multiprocessing
+
+    jobs = min(jobs or multiprocessing.cpu_count(), len(paths))
+    if jobs <= 1:
+        _init_worker(kwargs)
+        return map(func, paths)
+    pool = multiprocessing.Pool(jobs, _init_worker, (kwargs,))
+    results = pool.imap(func, paths)
+    pool.close()
+    return results
+
+
+# Modules for reading and writing compressed log files, by file extension
+_COMPRESSION_MODULES = {".gz": "gzip", ".bz2": "bz2", ".xz": "lzma"}
+
+# Name of the file listing the files `rewrite_directory` completed
+MANIFEST_NAME = ".anonip-manifest"
+
+# Prefix of the temporary files `rewrite_directory` writes to
+_TEMP_PREFIX = ".anonip-"
+
+
+def _open_log(path, mode="r"):
+    """
+    Open a log file for reading or writing text, compressed or not.
+
+    The compression is chosen by the file extension. Compressed files need
+    python 3.
+
+    :param path: str
+    :param mode: str, "r", "w" or "a"
+    :return: file handle
+    """
+    extension = os.path.splitext(path)[1]
+    if extension in _COMPRESSION_MODULES:
+        module = __import__(_COMPRESSION_MODULES[extension])
+        return module.open(path, mode + "t")
+    return open(path, mode)
+
+
+def _rewrite_file(path):
+    """
+    Anonymize a file in place.
+
+    The result is written to a temporary file in the same directory, which
+    atomically replaces the original file once complete.
+
+    :param path: str
+    :return: tuple (path, None or str with the error message)
+    """
+    import shutil
+    import tempfile
+
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(
+        prefix=_TEMP_PREFIX, suffix="-" + name, dir=directory
+    )
+    os.close(fd)
+    try:
+        with _open_log(path) as input_file, _open_log(temp_path, "w") as output_file:
+            for line in _worker_anonip.run(input_file):
+                output_file.write(line + "\n")
+        # keep the times, so retention policies based on them still work
+        shutil.copystat(path, temp_path)
+        stat = os.stat(path)
+        if hasattr(os, "chown") and os.stat(temp_path).st_uid != stat.st_uid:
+            os.chown(temp_path, stat.st_uid, stat.st_gid)  # pragma: no cover
+        # the file is recorded as done in the manifest afterwards, so it has
+        # to be on disk by then
+        _fsync(temp_path)
+        os.rename(temp_path, path)
+        _fsync(directory)
+    except Exception as err:
+        # e.g. EOFError for truncated gzip files: skip the file, but carry on
+        # with the others
+        return path, str(err) or type(err).__name__
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path, None
+
+
+def _fsync(path):
+    """
+    Flush a file or directory to disk.
+
+    :param path: str
+    :return: None
+    """
+    if os.path.isdir(path) and not hasattr(os, "O_DIRECTORY"):  # pragma: no cover
+        # directories can't be opened on Windows
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _find_log_files(directory):
+    """
+    Find all regular files in a directory tree.
+
+    Skips the manifest and temporary files of `rewrite_directory`.
+
+    :param directory: str
+    :return: list of str, relative paths
+    """
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if (
+                name == MANIFEST_NAME
+                or name.startswith(_TEMP_PREFIX)
+                or os.path.islink(path)
+                or not os.path.isfile(path)
+            ):
+                continue
+            paths.append(os.path.relpath(path, directory))
+    return paths
+
+
+def rewrite_directory(directory, kwargs, jobs=None):
+    """
+    Anonymize all log files in a directory tree in place.
+
+    The files are processed in parallel, one file per worker process.
+    Completed files are recorded in a manifest file in the directory, so an
+    interrupted run can be resumed and skips them. The manifest is removed
+    once all files are done, as log rotation reuses the names.
+
+    :param directory: str
+    :param kwargs: dict, arguments for `Anonip`
+    :param jobs: int or None, number of processes (default: number of CPUs)
+    :return: int, number of files which failed
+    """
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    done = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as manifest:
+            done = set(line.rstrip("\n") for line in manifest)
+    paths = [p for p in _find_log_files(directory) if p not in done]
+    logger.debug("Skipping %s completed files.", len(done))
+
+    failed = 0
+    if paths:
+        with open(manifest_path, "a", encoding="utf-8") as manifest:
+            full_paths = [os.path.join(directory, p) for p in paths]
+            for path, error in _map_files(_rewrite_file, full_paths, kwargs, jobs):
+                if error:
+                    logger.error("Failed to anonymize %s: %s", path, error)
+                    failed += 1
+                    continue
+                manifest.write(os.path.relpath(path, directory) + "\n")
+                manifest.flush()
+                os.fsync(manifest.fileno())
+    if not failed and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    return failed
+
+
+class _ByteRange(io.RawIOBase):
+    """
+    Read-only stream over a byte range of a file.
+    """
+
+    def __init__(self, path, start, end):
+        """
+        :param path: str
+        :param start: int, offset of the first byte
+        :param end: int, offset after the last byte
+        """
+        super(_ByteRange, self).__init__()
+        self._file = open(path, "rb", buffering=0)
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), self._remaining)
+        if size <= 0:
+            return 0
+        size = self._file.readinto(memoryview(b)[:size])
+        self._remaining -= size
+        return size
+
+    def close(self):
+        self._file.close()
+        super(_ByteRange, self).close()
+
+
+def _split_file(path, parts):
+    """
+    Split a file into byte ranges ending at line breaks.
+
+    :param path: str
+    :param parts: int, maximum number of ranges
+    :return: list of (start, end) tuples
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as f:
+        for i in range(1, parts):
+            # find the end of the line the byte before the offset is in
+            pos = max(size * i // parts, boundaries[-1] + 1) - 1
+            f.seek(pos)
+            chunk = f.read(65536)
+            while chunk and b"\n" not in chunk:
+                pos += len(chunk)
+                chunk = f.read(65536)
+            if not chunk:
+                break
+            boundary = pos + chunk.index(b"\n") + 1
+            if boundary < size:
+                boundaries.append(boundary)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _anonymize_range(task):
+    """
+    Anonymize a byte range of a file into a part file.
+
+    :param task: tuple (input path, start, end, part path)
+    :return: str, the part path
+    """
+    path, start, end, part_path = task
+    with io.TextIOWrapper(io.BufferedReader(_ByteRange(path, start, end))) as f:
+        with open(part_path, "w") as part:
+            for line in _worker_anonip.run(f):
+                part.write(line + "\n")
+    return part_path
+
+
+def _copy_fd(in_fd, out_fd):
+    """
+    Copy a whole file to the current position of another file descriptor.
+
+    Copies within the kernel (copy_file_range or sendfile) where possible.
+
+    :param in_fd: int, regular file
+    :param out_fd: int
+    :return: None
+    """
+    size = os.fstat(in_fd).st_size
+    offset = 0
+    for name in ("copy_file_range", "sendfile"):
+        func = getattr(os, name, None)
+        if not func:  # pragma: no cover
+            # python < 3.8 or not linux
+            continue
+        try:
+            while offset < size:
+                if name == "copy_file_range":
+                    copied = func(in_fd, out_fd, size - offset, offset)
+                else:
+                    copied = func(out_fd, in_fd, offset, size - offset)
+                if not copied:  # pragma: no cover
+                    break
+                offset += copied
+        except OSError as err:
+            # e.g. copying across file systems or to a file opened with O_APPEND
+            logger.debug("Falling back from %s: %s", name, err)
+        if offset >= size:
+            return
+
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    chunk = os.read(in_fd, 1 << 20)
+    while chunk:
+        written = os.write(out_fd, chunk)
+        chunk = chunk[written:] or os.read(in_fd, 1 << 20)
+
+
+def process_file_parallel(path, output_fd, kwargs, jobs=None, temp_dir=None):
+    """
+    Anonymize a large file using several processes.
+
+    The file is split into byte ranges aligned to line breaks. Each range is
+    anonymized into a temporary part file by a separate process. The parts
+    are then appended to the output in order.
+
+    :param path: str, regular file
+    :param output_fd: int, file descriptor to write to
+    :param kwargs: dict, arguments for `Anonip`
+    :param jobs: int or None, number of processes (default: number of CPUs)
+    :param temp_dir: str or None, directory to create the directory for the
+                     part files in (default: the system's temporary directory)
+    :return: None
+    """
+    import multiprocessing
+    import shutil
+    import tempfile
+
+    ranges = _split_file(path, jobs or multiprocessing.cpu_count())
+    temp_dir = tempfile.mkdtemp(prefix=_TEMP_PREFIX, dir=temp_dir)
+    try:
+        tasks = [
+            (path, start, end, os.path.join(temp_dir, "part-{}".format(i)))
+            for i, (start, end) in enumerate(ranges)
+        ]
+        for part_path in _map_files(_anonymize_range, tasks, kwargs, jobs):
+            in_fd = os.open(part_path, os.O_RDONLY)
+            try:
+                _copy_fd(in_fd, output_fd)
+            finally:
+                os.close(in_fd)
+            os.remove(part_path)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def audit(paths, kwargs, jobs=None, output_file=None):
+    """
+    Check that the given log files contain no addresses anonip would change.
+
+    The files are processed in parallel and are not modified.
+
+    :param paths: list of str
+    :param kwargs: dict, arguments for `Anonip`
+    :param jobs: int or None, number of processes (default: number of CPUs)
+    :param output_file: file handle to write the report to (default: sys.stdout)
+    :return: tuple (number of addresses which are not anonymized, number of
+             files which couldn't be read)
+    """
+    output_file = output_file or sys.stdout
+    unmasked = failed = 0
+    for result in _map_files(_audit_file, paths, kwargs, jobs):
+        unmasked += result["unmasked"]
+        report = (
+            "{path}: {lines} lines, {addresses} addresses, "
+            "{unmasked} not anonymized".format(**result)
+        )
+        if result["error"]:
+            failed += 1
+            report += ", failed: " + result["error"]
+        print(report, file=output_file)
+        for lineno, ip_str in result["samples"]:
+            print(
+                "  {}:{}: {}".format(result["path"], lineno, ip_str), file=output_file
+            )
+    return unmasked, failed
+
+
+def _compress_block(block, level):
+    """
+    Compress a block of data into a complete gzip member.
+
+    :param block: bytes
+    :param level: int, compression level
+    :return: bytes
+    """
+    import zlib
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+class _GzipBlockWriter(object):
+    """
+    Text file writing gzip compressed data, compressed on a pool of threads.
+
+    The data is cut into blocks at write boundaries, and each block is
+    compressed into a separate gzip member (like pigz does). Concatenated,
+    the members form a valid gzip file, which zcat reads as a whole. zlib
+    releases the GIL, so the blocks are compressed in parallel.
+
+    `flush` does nothing: the data is written once a block is full or the
+    file gets closed.
+    """
+
+    def __init__(self, raw, block_size=131072, threads=None, level=6):
+        """
+        :param raw: binary file handle to write to
+        :param block_size: int, uncompressed size of a block in bytes
+        :param threads: int or None, number of threads (default: number of CPUs)
+        :param level: int, compression level
+        """
+        import locale
+        import multiprocessing
+        from collections import deque
+        from multiprocessing.pool import ThreadPool
+
+        threads = threads or multiprocessing.cpu_count()
+        self._raw = raw
+        self._block_size = block_size
+        self._level = level
+        # same encoding as for files opened in text mode
+        self._encoding = locale.getpreferredencoding(False)
+        self._pool = ThreadPool(threads)
+        self._max_pending = 2 * threads
+        self._pending = deque()
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        data = data.encode(self._encoding)
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self._block_size:
+            self._submit()
+
+    def flush(self):
+        pass
+
+    def _submit(self):
+        block = b"".join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        self._pending.append(
+            self._pool.apply_async(_compress_block, (block, self._level))
+        )
+        # bound memory usage, and write the blocks in order
+        while len(self._pending) > self._max_pending:
+            self._raw.write(self._pending.popleft().get())
+
+    def close(self):
+        """
+        Write all remaining data. Does not close the underlying file.
+
+        :return: None
+        """
+        if self._pool is None:
+            return
+        if self._buffer:
+            self._submit()
+        while self._pending:
+            self._raw.write(self._pending.popleft().get())
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        self._raw.flush()
+
+
+# Errors after which sending to syslog is retried on a new connection
+_SYSLOG_CONNECTION_ERRORS = set(
+    getattr(errno, name)
+    for name in (
+        "ECONNREFUSED",
+        "ECONNRESET",
+        "ECONNABORTED",
+        "EPIPE",
+        "ENOTCONN",
+        "ENOENT",
+        "ETIMEDOUT",
+        "EHOSTUNREACH",
+        "EHOSTDOWN",
+        "ENETUNREACH",
+        "ENETDOWN",
+        "EAGAIN",
+    )
+    if hasattr(errno, name)
+)
+
+# Size datagrams too long for the socket are truncated to, which every syslog
+# daemon accepts (RFC 5424, section 6.1)
+_SYSLOG_TRUNCATE_SIZE = 2048
+
+SYSLOG_FACILITIES = (
+    "kern user mail daemon auth syslog lpr news uucp cron authpriv ftp".split()
+    + [None] * 4
+    + ["local{}".format(i) for i in range(8)]
+)
+
+
+class _SyslogWriter(object):
+    """
+    Text file sending each line as a message to a syslog daemon.
+
+    `address` is either the path of a Unix socket (datagram, or stream if the
+    daemon listens on a stream socket) or "tcp://host:port". Over TCP, the
+    messages are RFC 5424 formatted and octet-counted (RFC 6587). Over Unix
+    sockets, they use the short format of the local syslog() call.
+
+    Written lines are collected until `flush` is called or `max_size` bytes
+    are buffered, and then sent at once: in a single write on stream
+    sockets, one datagram per message otherwise. The connection is kept open
+    and re-established with exponential backoff when it fails; other errors
+    are raised. Datagrams too long for the socket are truncated.
+    """
+
+    def __init__(
+        self,
+        address,
+        tag="anonip",
+        facility="user",
+        max_size=65536,
+        backoff=0.1,
+        max_backoff=30.0,
+        retries=None,
+    ):
+        """
+        :param address: str, path of a Unix socket or "tcp://host:port"
+        :param tag: str, APP-NAME of the messages
+        :param facility: str, one of SYSLOG_FACILITIES
+        :param max_size: int, number of buffered bytes triggering a send
+        :param backoff: float, seconds to wait before the first reconnect
+        :param max_backoff: float, maximum seconds to wait between reconnects
+        :param retries: int or None, failed sends before giving up (default:
+                        never give up)
+        """
+        import socket
+
+        self._socket_module = socket
+        self._address = address
+        self._tcp = address.startswith("tcp://")
+        self._datagram = not self._tcp
+        self._max_size = max_size
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._retries = retries
+        self._sock = None
+        self._partial = ""
+        self._messages = []
+        self.truncated = 0
+        self._size = 0
+        # severity informational
+        pri = SYSLOG_FACILITIES.index(facility) * 8 + 6
+        if self._tcp:
+            self._prefix = "<{}>1 {{}} {} {} {} - - ".format(
+                pri, socket.gethostname() or "-", tag, os.getpid()
+            )
+        else:
+            self._prefix = "<{}>{}[{}]: ".format(pri, tag, os.getpid())
+
+    def write(self, data):
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._add(line)
+        if self._size >= self._max_size:
+            self._send()
+
+    def flush(self):
+        if self._messages:
+            self._send()
+
+    def close(self):
+        """
+        Send all remaining lines and close the connection.
+
+        :return: None
+        """
+        if self._partial:
+            self._add(self._partial)
+            self._partial = ""
+        self.flush()
+        self._disconnect()
+
+    def _add(self, line):
+        if self._tcp:
+            now = time.time()
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now))
+            timestamp += ".{:06d}Z".format(int(now % 1 * 1000000))
+            message = (self._prefix.format(timestamp) + line).encode("utf-8")
+            message = str(len(message)).encode("ascii") + b" " + message
+        else:
+            message = (self._prefix + line).encode("utf-8")
+            if not self._datagram:
+                message += b"\n"
+        self._messages.append(message)
+        self._size += len(message)
+
+    def _connect(self):
+        socket = self._socket_module
+        if self._tcp:
+            host, _, port = self._address[len("tcp://") :].rpartition(":")
+            self._sock = socket.create_connection((host.strip("[]"), int(port)))
+            return
+        # on errors, the socket is closed by _send
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self._sock.connect(self._address)
+        except EnvironmentError as err:
+            if err.errno != errno.EPROTOTYPE:
+                raise
+            # the daemon listens on a stream socket
+            self._sock.close()
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(self._address)
+            self._datagram = False
+            self._messages = [m + b"\n" for m in self._messages]
+
+    def _disconnect(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _send_datagrams(self):
+        sent = 0
+        try:
+            for message in self._messages:
+                try:
+                    self._sock.send(message)
+                except EnvironmentError as err:
+                    if err.errno != errno.EMSGSIZE:
+                        raise
+                    self._send_truncated(message)
+                sent += 1
+        finally:
+            # don't repeat the sent messages after an error
+            del self._messages[:sent]
+
+    def _send_truncated(self, message):
+        self.truncated += 1
+        logger.warning(
+            "Syslog message of %s bytes is too long, truncating it to %s bytes "
+            "(%s messages truncated so far).",
+            len(message),
+            _SYSLOG_TRUNCATE_SIZE,
+            self.truncated,
+        )
+        message = message[:_SYSLOG_TRUNCATE_SIZE]
+        # don't cut a multi-byte character in half
+        self._sock.send(message.decode("utf-8", "ignore").encode("utf-8"))
+
+    def _send(self):
+        delay = self._backoff
+        failures = 0
+        while True:
+            try:
+                if not self._sock:
+                    self._connect()
+                if self._datagram:
+                    self._send_datagrams()
+                else:
+                    self._sock.sendall(b"".join(self._messages))
+                    self._messages = []
+                self._size = 0
+                return
+            except EnvironmentError as err:
+                self._disconnect()
+                failures += 1
+                if not self._is_connection_error(err) or (
+                    self._retries is not None and failures > self._retries
+                ):
+                    raise
+                logger.warning(
+                    "Sending to syslog at %s failed (%s), retrying in %ss.",
+                    self._address,
+                    err,
+                    delay,
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, self._max_backoff)
+
+    def _is_connection_error(self, err):
+        # name resolution errors have negative numbers of their own
+        if isinstance(err, self._socket_module.gaierror):
+            return True
+        return err.errno in _SYSLOG_CONNECTION_ERRORS
+
+
+def _argument_error(msg):
+    """
+    Create the error for an invalid command line argument.
+
+    argparse is only imported when the arguments get parsed.
+
+    :param msg: str
+    :return: argparse.ArgumentTypeError
+    """
+    import argparse
+
+    return argparse.ArgumentTypeError(msg)
+
+
+def _validate_ipmask(mask, bits=32):
+    """
+    Verify if the supplied ip mask is valid.
+
+    :param mask: the provided ip mask
+    :param bits: 32 for ipv4, 128 for ipv6
+    :return: int
+    """
+    msg = "must be an integer between 1 and {}".format(bits)
+    try:
+        mask = int(mask)
+    except ValueError:
+        raise _argument_error(msg)
+
+    if not 0 < mask <= bits:
+        raise _argument_error(msg)
+
+    return mask
+
+
+def _validate_integer_ht_0(value):
+    """
+    Validate if given string is a number higher than 0.
+
+    :param value: str or int
+    :return: int
+    """
+    msg = "must be a positive integer"
+    try:
+        value = int(value)
+    except ValueError:
+        raise _argument_error(msg)
+    if not value >= 1:
+        raise _argument_error(msg)
+    return value
+
+
+def regex_arg_type(value):
+    try:
+        re.compile(value)
+    except re.error as e:
+        msg = "must be a valid regex."
+        if hasattr(e, "msg"):  # pragma: no cover
+            # not available on py27
+            msg = "must be a valid regex. Error: {}".format(e.msg)
+        raise _argument_error(msg)
+    return value
+
+
+def log_format_arg_type(value):
+    try:
+        compile_log_format(value)
+    except ValueError as e:
+        raise _argument_error("must be a valid log format. Error: {}".format(e))
+    return value
+
+
+def _read_key_file(path):
+    """
+    Read the key for pseudonymization from a file.
+
+    :param path: str
+    :return: bytes
+    """
+    try:
+        with open(path, "rb") as f:
+            key = f.read()
+    except IOError as e:
+        raise _argument_error("can't read key file: {}".format(e))
+    if not key:
+        raise _argument_error("key file is empty")
+    return key
+
+
+def _check_modes(parser, args):
+    """
+    Reject options which don't go together with the chosen mode.
+
+    :param parser: argparse.ArgumentParser
+    :param args: argparse.Namespace
+    :return: None
+    """
+    if args.auto and (
+        args.regex
+        or args.log_format
+        or args.columns is not None
+        or args.delimiter is not None
+        or args.audit
+        or args.recursive
+    ):
+        raise parser.error(
+            'Ambiguous arguments: When using "--auto", "--log-format", "--regex", '
+            '"-c", "-l", "--audit" and "--recursive" can\'t be used.'
+        )
+    if args.recursive and (args.audit or args.input or args.output):
+        raise parser.error(
+            'Ambiguous arguments: When using "--recursive", "--audit", "--input" '
+            'and "--output" can\'t be used.'
+        )
+    if args.syslog and (args.output or args.gzip or args.audit or args.recursive):
+        raise parser.error(
+            'Ambiguous arguments: When using "--syslog", "--output", "--gzip", '
+            '"--audit" and "--recursive" can\'t be used.'
+        )
+
+
+def parse_arguments(args):
+    """
+    Parse all given arguments.
+
+    :param args: list
+    :return: argparse.Namespace
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=__description__,
+        epilog="Example-usage in apache-config:\n"
+        'CustomLog "| /path/to/anonip.py '
+        '[OPTIONS] --output /path/to/log" '
+        "combined\n ",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-4",
+        "--ipv4mask",
+        metavar="INTEGER",
+        help="truncate the last n bits (default: %(default)s)",
+        type=lambda x: _validate_ipmask(x, 32),
+    )
+    parser.set_defaults(ipv4mask=12)
+    parser.add_argument(
+        "-6",
+        "--ipv6mask",
+        type=lambda x: _validate_ipmask(x, 128),
+        metavar="INTEGER",
+        help="truncate the last n bits (default: %(default)s)",
+    )
+    parser.set_defaults(ipv6mask=84)
+    parser.add_argument(
+        "-i",
+        "--increment",
+        metavar="INTEGER",
+        type=lambda x: _validate_integer_ht_0(x),
+        help="increment the IP address by n (default: %(default)s)",
+    )
+    parser.set_defaults(increment=0)
+    parser.add_argument("-o", "--output", metavar="FILE", help="file to write to")
+    parser.add_argument(
+        "-z",
+        "--gzip",
+        action="store_true",
+        help="write gzip compressed output, compressing blocks in parallel; "
+        "blocks are written once full or on exit (also within 5 s of SIGTERM), "
+        "so up to a few blocks are lost if anonip gets killed otherwise",
+    )
+    parser.add_argument(
+        "--gzip-block-size",
+        metavar="INTEGER",
+        type=lambda x: _validate_integer_ht_0(x),
+        default=131072,
+        help="size of the blocks compressed in parallel in bytes "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--gzip-threads",
+        metavar="INTEGER",
+        type=lambda x: _validate_integer_ht_0(x),
+        help="number of compression threads (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--input", metavar="FILE", help="File or FIFO to read from (default: stdin)"
+    )
+    parser.add_argument(
+        "-c",
+        "--column",
+        metavar="INTEGER",
+        dest="columns",
+        nargs="+",
+        type=lambda x: _validate_integer_ht_0(x),
+        help="assume IP address is in column n (1-based indexed; default: 1)",
+    )
+    parser.add_argument(
+        "-l",
+        "--delimiter",
+        metavar="STRING",
+        type=str,
+        help='log delimiter (default: " ")',
+    )
+    parser.add_argument(
+        "--regex",
+        metavar="STRING",
+        nargs="+",
+        help="regex for detecting IP addresses (use optionally instead of -c)",
+        type=regex_arg_type,
+    )
+    parser.add_argument(
+        "--log-format",
+        metavar="STRING",
+        help="Apache LogFormat or nginx log_format string, or one of the "
+        'nicknames "common" and "combined", to locate IP addresses '
+        "(use optionally instead of -c); fields which can contain spaces, "
+        'like "%%r" or headers, must be enclosed in quotes or brackets',
+        type=log_format_arg_type,
+    )
+    parser.add_argument(
+        "--auto",
+        action="store_true",
+        help="detect the log format from the first lines and choose the fastest "
+        "way to find the IP addresses (use optionally instead of -c)",
+    )
+    parser.add_argument(
+        "--auto-sample",
+        metavar="INTEGER",
+        type=lambda x: _validate_integer_ht_0(x),
+        default=100,
+        help="number of lines to detect the format from (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--auto-timeout",
+        metavar="INTEGER",
+        type=lambda x: _validate_integer_ht_0(x),
+        default=5,
+        help="maximum seconds to wait for these lines; nothing is written "
+        "before (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-r",
+        "--replace",
+        metavar="STRING",
+        help="replacement string in case address parsing fails (Example: 0.0.0.0)",
+    )
+    parser.add_argument(
+        "-p",
+        "--skip-private",
+        dest="skip_private",
+        action="store_true",
+        help="do not mask addresses in private ranges. "
+        "See IANA Special-Purpose Address Registry.",
+    )
+    parser.add_argument(
+        "--pseudonymize",
+        metavar="KEYFILE",
+        dest="pseudonymize_key",
+        type=_read_key_file,
+        help="replace addresses by pseudonyms derived from the key in KEYFILE "
+        "instead of truncating them",
+    )
+    parser.add_argument(
+        "--key-rotation",
+        choices=["none", "daily"],
+        default="none",
+        help="derive a new pseudonymization key every day (UTC), so "
+        "pseudonyms can't be linked across days (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pseudonym-cache",
+        metavar="INTEGER",
+        type=int,
+        default=65536,
+        help="number of pseudonyms to keep cached (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-line-length",
+        metavar="INTEGER",
+        type=lambda x: _validate_integer_ht_0(x),
+        help="truncate lines longer than n characters (default: no limit)",
+    )
+    parser.add_argument(
+        "--writer-queue",
+        metavar="INTEGER",
+        type=lambda x: _validate_integer_ht_0(x),
+        help="write from a separate thread, queueing up to n lines",
+    )
+    parser.add_argument(
+        "--queue-full",
+        choices=["block", "spill", "drop"],
+        default="block",
+        help="what to do when the writer queue is full: wait, buffer the lines "
+        "in a temporary file or drop them (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--syslog",
+        metavar="ADDRESS",
+        help='send the lines to syslog, at a Unix socket path (e.g. "/dev/log") '
+        'or "tcp://host:port"',
+    )
+    parser.add_argument(
+        "--syslog-tag",
+        metavar="STRING",
+        default="anonip",
+        help="tag of the syslog messages (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--syslog-facility",
+        choices=[f for f in SYSLOG_FACILITIES if f],
+        default="user",
+        metavar="FACILITY",
+        help="facility of the syslog messages (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--audit",
+        metavar="FILE",
+        nargs="+",
+        help="do not anonymize, but check that the given files contain no "
+        "addresses which are not anonymized",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="INTEGER",
+        type=lambda x: _validate_integer_ht_0(x),
+        help="number of processes for --audit and --recursive (default: number "
+        "of CPUs); with n > 1, a regular file given by --input is split into "
+        "n parts processed in parallel",
+    )
+    parser.add_argument(
+        "--recursive",
+        metavar="DIR",
+        help="anonymize all files in DIR and its subdirectories in place, "
+        "including compressed ones (.gz, .bz2, .xz); with --pseudonymize, "
+        "run it once only",
+    )
+    parser.add_argument(
+        "-d", "--debug", action="store_true", help="print debug messages"
+    )
+    parser.add_argument("-v", "--version", action="version", version=__version__)
+
+    args = parser.parse_args(args)
+
+    if args.regex and (args.columns is not None or args.delimiter is not None):
+        raise parser.error(
+            'Ambiguous arguments: When using "--regex", "-c" and "-l" can\'t be used.'
+        )
+    if args.log_format and (
+        args.regex or args.columns is not None or args.delimiter is not None
+    ):
+        raise parser.error(
+            'Ambiguous arguments: When using "--log-format", "--regex", "-c" and '
+            '"-l" can\'t be used.'
+        )
+    _check_modes(parser, args)
+    if not args.regex and args.columns is None:
+        args.columns = [1]
+    if not args.regex and args.delimiter is None:
+        args.delimiter = " "
+
+    return args
+
+
+def _anonip_kwargs(args):
+    """
+    Get the arguments for `Anonip` from the parsed command line.
+
+    :param args: argparse.Namespace
+    :return: dict
+    """
+    return dict(
+        columns=args.columns,
+        ipv4mask=args.ipv4mask,
+        ipv6mask=args.ipv6mask,
+        increment=args.increment,
+        delimiter=args.delimiter,
+        replace=args.replace,
+        regex=args.regex,
+        skip_private=args.skip_private,
+        max_line_length=args.max_line_length,
+        log_format=args.log_format,
+        pseudonymize_key=args.pseudonymize_key,
+        key_rotation=None if args.key_rotation == "none" else args.key_rotation,
+        cache_size=args.pseudonym_cache,
+    )
+
+
+def _open_output(args):
+    """
+    Open the file the anonymized lines are written to.
+
+    :param args: argparse.Namespace
+    :return: tuple (file handle, list of file handles to close in order)
+    """
+    if args.syslog:
+        output_file = _SyslogWriter(args.syslog, args.syslog_tag, args.syslog_facility)
+        return output_file, [output_file]
+    if args.gzip:
+        if args.output:
+            raw = open(args.output, "ab")
+        else:
+            # compatibility for python < 3
+            raw = getattr(sys.stdout, "buffer", sys.stdout)
+        output_file = _GzipBlockWriter(raw, args.gzip_block_size, args.gzip_threads)
+        return output_file, [output_file, raw] if args.output else [output_file]
+    if args.output:
+        output_file = open(args.output, "a")
+        return output_file, [output_file]
+    return sys.stdout, []
+
+
+def _sample_input(anonip, input_file, size, timeout):
+    """
+    Detect the format from the first lines of the input.
+
+    Detection starts once `size` lines have been read, or with the lines read
+    so far after `timeout` seconds, so nothing is held back for long on
+    inputs with little traffic.
+
+    :param anonip: Anonip
+    :param input_file: file handle
+    :param size: int, number of lines to sample
+    :param timeout: float, maximum seconds to wait for the lines
+    :return: file handle returning the sampled lines first
+    """
+    import threading
+
+    lines = []
+    stop = threading.Event()
+
+    def read():
+        while len(lines) < size and not stop.is_set():
+            line = anonip._readline(input_file)
+            if not line:
+                break
+            lines.append(line)
+
+    reader = threading.Thread(target=read, name="anonip-sampler")
+    reader.daemon = True
+    reader.start()
+    reader.join(timeout)
+    stop.set()
+    # the reader may append one more line, which is returned, but not sampled
+    autodetect(anonip, lines[:])
+    return _PrefixedFile(lines, input_file, reader)
+
+
+def _anonymize_stream(anonip, args):
+    """
+    Anonymize the input stream and write it to the output.
+
+    :param anonip: Anonip
+    :param args: argparse.Namespace
+    :return: None
+    """
+    import signal
+
+    input_file = writer = deadline = None
+    to_close = []
+    previous_handlers = {}
+    if args.gzip:
+        # the gzip writer holds blocks back, which are written by the finally
+        # clause below
+        previous_handlers[signal.SIGTERM] = signal.signal(signal.SIGTERM, _terminate)
+    try:
+        if args.input:
+            input_file = open(args.input, "r")
+        output_file, to_close = _open_output(args)
+        if args.auto:
+            input_file = _sample_input(
+                anonip, input_file or sys.stdin, args.auto_sample, args.auto_timeout
+            )
+        if args.writer_queue or args.syslog:
+            # lines waiting in the queue are sent to syslog in batches
+            writer = _QueuedWriter(
+                output_file, args.writer_queue or 1024, args.queue_full
+            )
+            previous_handlers.update(_log_stats_on_signal(writer))
+        _write_lines(anonip, input_file, output_file, writer)
+    except SystemExit as err:
+        # stopped by SIGTERM: don't hang on a stalled output while writing
+        # out the buffered lines
+        deadline = _exit_after(_TERMINATE_TIMEOUT, err.code)
+        raise
+    except IOError as err:  # pragma: no cover
+        logger.error(err)
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    finally:
+        _close_stream(args, input_file, writer, to_close)
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        if deadline:
+            deadline.cancel()
+
+
+def _write_lines(anonip, input_file, output_file, writer):
+    """
+    :param anonip: Anonip
+    :param input_file: file handle or None for stdin
+    :param output_file: file handle
+    :param writer: _QueuedWriter or None
+    :return: None
+    """
+    for line in anonip.run(input_file):
+        if writer:
+            writer.write_line(line)
+            continue
+        print(unicode(line), file=output_file)
+        # TODO: when dropping support for Python <= 3.3, move the
+        # flush into the print()
+        output_file.flush()
+
+
+def _close_stream(args, input_file, writer, to_close):
+    """
+    :param args: argparse.Namespace
+    :param input_file: file handle or None
+    :param writer: _QueuedWriter or None
+    :param to_close: list of file handles
+    :return: None
+    """
+    if args.input and input_file:
+        input_file.close()
+    if writer:
+        try:
+            writer.close()
+        except IOError as err:  # pragma: no cover
+            logger.error(err)
+    for f in to_close:
+        f.close()
+
+
+def _log_stats_on_signal(writer):
+    """
+    Log the statistics of the writer queue on SIGUSR1, to watch it while
+    anonip runs.
+
+    :param writer: _QueuedWriter
+    :return: dict of the previous signal handlers
+    """
+    import signal
+
+    if not hasattr(signal, "SIGUSR1"):  # pragma: no cover
+        # Windows
+        return {}
+
+    def log_stats(signum, frame):
+        writer.log_stats(logging.WARNING)
+
+    return {signal.SIGUSR1: signal.signal(signal.SIGUSR1, log_stats)}
+
+
+# Seconds to write out the buffered lines after SIGTERM, before exiting anyway
+_TERMINATE_TIMEOUT = 5
+
+
+def _terminate(signum, frame):
+    """
+    Signal handler exiting like `sys.exit`, e.g. when the webserver stops a
+    piped logger with SIGTERM. Another signal ends the process right away.
+    """
+    import signal
+
+    signal.signal(signum, signal.SIG_DFL)
+    raise SystemExit(128 + signum)
+
+
+def _exit_after(timeout, status):
+    """
+    End the process after `timeout` seconds, unless the timer is cancelled.
+
+    :param timeout: float
+    :param status: int, exit status
+    :return: threading.Timer
+    """
+    import threading
+
+    def exit():
+        logger.error("Could not write the buffered lines within %s s.", timeout)
+        os._exit(status)
+
+    timer = threading.Timer(timeout, exit)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def _can_split(args):
+    """
+    Check whether the input can be split for processing in parallel.
+
+    :param args: argparse.Namespace
+    :return: bool
+    """
+    return bool(
+        args.input
+        and os.path.isfile(args.input)
+        and os.path.splitext(args.input)[1] not in _COMPRESSION_MODULES
+        and not args.writer_queue
+        and not args.gzip
+        and not args.auto
+        and not args.syslog
+    )
+
+
+def _anonymize_file_parallel(args, kwargs):
+    """
+    Anonymize the input file in parallel and append it to the output.
+
+    :param args: argparse.Namespace
+    :param kwargs: dict, arguments for `Anonip`
+    :return: None
+    """
+    temp_dir = None
+    if args.output:
+        # not O_APPEND, the kernel can't copy to such files
+        output_fd = os.open(args.output, os.O_WRONLY | os.O_CREAT, 0o666)
+        os.lseek(output_fd, 0, os.SEEK_END)
+        # keep the parts, as large as the input, off /tmp (often in memory),
+        # and on the filesystem of the output, where they can be copied by
+        # the kernel
+        temp_dir = os.path.dirname(os.path.abspath(args.output))
+    else:
+        sys.stdout.flush()
+        output_fd = sys.stdout.fileno()
+    try:
+        process_file_parallel(args.input, output_fd, kwargs, args.jobs, temp_dir)
+    finally:
+        if args.output:
+            os.close(output_fd)
+
+
+def main():
+    """
+    Main CLI function for anonip.
+
+    :return: int, exit status
+    """
+    args = parse_arguments(sys.argv[1:])
+
+    logging.basicConfig()
+    if args.debug:
+        logger.level = logging.DEBUG
+    else:
+        logger.level = logging.WARNING
+
+    kwargs = _anonip_kwargs(args)
+    if args.audit:
+        unmasked, failed = audit(args.audit, kwargs, args.jobs)
+        return 1 if unmasked or failed else 0
+    if args.recursive:
+        failed = rewrite_directory(args.recursive, kwargs, args.jobs)
+        return 1 if failed else 0
+
+    if args.jobs and args.jobs > 1 and _can_split(args):
+        _anonymize_file_parallel(args, kwargs)
+        return 0
+
+    _anonymize_stream(Anonip(**kwargs), args)
+    return 0
 
 
 if __name__ == "__main__":  # pragma: no cover
-    main()
+    sys.exit(main())
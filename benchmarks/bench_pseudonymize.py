@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the cost per line of pseudonymization against plain truncation.
+
+Usage: python benchmarks/bench_pseudonymize.py [NUMBER_OF_LINES]
+
+"all misses" processes distinct addresses only, so every line computes an HMAC.
+"cached" processes a small set of recurring addresses, as it is typical for
+access logs.
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import anonip  # noqa: E402
+
+LINE = '{} - - [20/May/2015:21:05:01 +0000] "GET / HTTP/1.1" 200 13358 "-" "ua"'
+
+
+def make_lines(count, distinct):
+    rng = random.Random(42)
+    addresses = [
+        "{}.{}.{}.{}".format(*(rng.randint(1, 254) for _ in range(4)))
+        for _ in range(distinct)
+    ]
+    return [LINE.format(addresses[i % distinct]) for i in range(count)]
+
+
+def bench(name, anonymizer, lines, repeat=5):
+    process_line = anonymizer.process_line
+    timer = timeit.Timer(lambda: [process_line(line) for line in lines])
+    best = min(timer.repeat(repeat=repeat, number=1))
+    print("{:<24} {:8.2f} µs/line".format(name, best / len(lines) * 1e6))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    key = b"benchmark key"
+    recurring = make_lines(count, 1000)
+    distinct = make_lines(count, count)
+
+    bench("truncate", anonip.Anonip(), recurring)
+    bench("pseudonymize, all misses", anonip.Anonip(pseudonymize_key=key), distinct)
+    bench(
+        "pseudonymize, cache off",
+        anonip.Anonip(pseudonymize_key=key, cache_size=0),
+        recurring,
+    )
+    bench("pseudonymize, cached", anonip.Anonip(pseudonymize_key=key), recurring)
+    bench(
+        "pseudonymize, daily key",
+        anonip.Anonip(pseudonymize_key=key, key_rotation="daily"),
+        recurring,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark many --regex patterns: one alternation against the prefiltered
+dispatch anonip uses.
+
+Usage: python benchmarks/bench_regex.py [NUMBER_OF_PATTERNS] [NUMBER_OF_LINES]
+
+Each pattern stands for the log format of another service, and the lines
+are spread evenly across the formats.
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import anonip  # noqa: E402
+
+LINE = "service{0}[1234]: connection from {1} port 22 to {2} ({0})"
+PATTERN = r"service{}\[\d+\]: connection from (\S+) port \d+ to (\S+)"
+
+
+def make_lines(patterns, count):
+    return [
+        LINE.format(i % patterns, "1.2.3.{}".format(i % 250), "2001:db8::1")
+        for i in range(count)
+    ]
+
+
+def per_line(func, lines, repeat):
+    timer = timeit.Timer(lambda: [func(line) for line in lines])
+    return min(timer.repeat(repeat=repeat, number=1)) / len(lines) * 1e6
+
+
+def bench(name, regex, lines, repeat=5):
+    anonymizer = anonip.Anonip(regex=regex)
+    print(
+        "{:<12} {:8.2f} µs/line matching, {:8.2f} µs/line total".format(
+            name,
+            per_line(anonymizer._regex_dispatcher.match, lines, repeat),
+            per_line(anonymizer.process_line, lines, repeat),
+        )
+    )
+
+
+def main():
+    patterns = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    regexes = [PATTERN.format(i) for i in range(patterns)]
+    lines = make_lines(patterns, count)
+
+    bench("alternation", re.compile("|".join(regexes)), lines)
+    bench("dispatch", regexes, lines)
+
+
+if __name__ == "__main__":
+    main()
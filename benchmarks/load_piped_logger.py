@@ -0,0 +1,355 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Load test anonip the way Apache runs it as a piped logger.
+
+Usage: python benchmarks/load_piped_logger.py [OPTIONS] [-- ANONIP_OPTIONS]
+
+The anonip CLI is started as a child process, like for
+`CustomLog "|anonip.py ..."`, and many writer threads (the Apache workers)
+write whole lines to its stdin, each at a fixed rate. As Apache does, every
+line is written with a single write(2) of less than PIPE_BUF bytes, so lines
+of different writers never interleave.
+
+Reported are the sustained throughput, the latency from writing a line to
+reading it back from anonip's stdout (percentiles), how often the pipe was
+full (a write would have blocked the writer) and for how long, and the RSS
+of anonip over time.
+
+Every line carries the time it was scheduled to be written, so a writer
+stalled on a full pipe doesn't hide the delay from the latency figures. The
+lines are generated from a fixed seed, and --repeat runs the same load
+several times to see the spread. Linux only (uses /proc for the RSS).
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import select
+import subprocess
+import sys
+import threading
+import time
+
+ANONIP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "anonip.py")
+
+REQUEST = "GET /load/{{}}/{} HTTP/1.1"
+LINE_KINDS = {
+    "combined": '{} - - [20/May/2015:21:05:01 +0000] "' + REQUEST + '" 200 13358 '
+    '"https://example.com/" "Mozilla/5.0 (X11; Linux x86_64)"',
+    "common": '{} - - [20/May/2015:21:05:01 +0000] "' + REQUEST + '" 304 -',
+    "long": '{} - - [20/May/2015:21:05:01 +0000] "' + REQUEST + '" 200 13358 '
+    '"https://example.com/?q=' + "x" * 1500 + '" "' + "Mozilla/5.0 " * 100 + '"',
+}
+MARKER = re.compile(rb"/load/(\d+)/")
+
+
+def make_templates(rng, mix, count=1000):
+    """
+    Generate line templates following the weights of `mix`.
+
+    A template takes the schedule time of the line (in µs) as argument.
+    """
+    kinds, weights = zip(*mix.items())
+    templates = []
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        if rng.random() < 0.2:
+            address = "2001:db8:{:x}::{:x}".format(rng.randrange(65536), i)
+        else:
+            address = "{}.{}.{}.{}".format(*(rng.randint(1, 254) for _ in range(4)))
+        line = LINE_KINDS[kind].format(address, i) + "\n"
+        assert len(line) < select.PIPE_BUF, "lines must be written atomically"
+        templates.append(line)
+    return templates
+
+
+class Writer(threading.Thread):
+    """
+    Write lines to the pipe at a fixed rate, like an Apache worker.
+    """
+
+    def __init__(self, fd, templates, rate, start, stop):
+        threading.Thread.__init__(self, daemon=True)
+        self.fd = fd
+        self.templates = templates
+        self.interval = 1.0 / rate if rate else 0
+        self.start_time = start
+        self.stop_time = stop
+        self.lines = 0
+        self.stalls = 0
+        self.stalled = 0.0
+
+    def run(self):
+        scheduled = self.start_time
+        while True:
+            now = time.monotonic()
+            if self.interval:
+                if scheduled > now:
+                    time.sleep(scheduled - now)
+            else:
+                scheduled = now
+            if scheduled >= self.stop_time:
+                return
+            template = self.templates[self.lines % len(self.templates)]
+            self.write(template.format(int(scheduled * 1e6)).encode())
+            self.lines += 1
+            scheduled += self.interval
+
+    def write(self, data):
+        while True:
+            try:
+                os.write(self.fd, data)
+                return
+            except BlockingIOError:
+                # the pipe is full: Apache would block here
+                self.stalls += 1
+                start = time.monotonic()
+                select.select([], [self.fd], [])
+                self.stalled += time.monotonic() - start
+
+
+class Reader(threading.Thread):
+    """
+    Read anonip's output and record the latency of each line.
+    """
+
+    def __init__(self, output):
+        threading.Thread.__init__(self, daemon=True)
+        self.output = output
+        self.latencies = []
+        self.unmarked = 0
+        self.last = None
+
+    def run(self):
+        for line in self.output:
+            now = time.monotonic()
+            match = MARKER.search(line)
+            if match:
+                self.latencies.append(now - int(match.group(1)) / 1e6)
+            else:
+                self.unmarked += 1
+            self.last = now
+
+
+class RSSSampler(threading.Thread):
+    """
+    Sample the resident set size of a process.
+    """
+
+    def __init__(self, pid, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = "/proc/{}/status".format(pid)
+        self.interval = interval
+        self.samples = []
+        self.done = threading.Event()
+
+    def run(self):
+        start = time.monotonic()
+        while not self.done.is_set():
+            try:
+                with open(self.path) as f:
+                    status = f.read()
+            except OSError:
+                return
+            match = re.search(r"^VmRSS:\s+(\d+) kB", status, re.M)
+            if match:
+                self.samples.append(
+                    (round(time.monotonic() - start, 3), int(match.group(1)))
+                )
+            self.done.wait(self.interval)
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run_load(args, seed):
+    """
+    Run anonip once under load.
+
+    :return: dict of results
+    """
+    child = subprocess.Popen(
+        [sys.executable, ANONIP] + args.anonip_args,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    fd = child.stdin.fileno()
+    os.set_blocking(fd, False)
+    reader = Reader(child.stdout)
+    sampler = RSSSampler(child.pid, args.rss_interval)
+    reader.start()
+    sampler.start()
+
+    # give the interpreter time to start, like a long running Apache would
+    time.sleep(args.startup)
+    start = time.monotonic()
+    stop = start + args.duration
+    writers = [
+        Writer(
+            fd,
+            make_templates(random.Random(seed + i), args.mix),
+            args.rate,
+            start,
+            stop,
+        )
+        for i in range(args.writers)
+    ]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    os.set_blocking(fd, True)
+    child.stdin.close()
+    child.wait()
+    reader.join()
+    sampler.done.set()
+    sampler.join()
+
+    latencies = sorted(reader.latencies)
+    elapsed = (reader.last or stop) - start
+    rss = [kb for _, kb in sampler.samples]
+    return {
+        "sent": sum(w.lines for w in writers),
+        "received": len(latencies) + reader.unmarked,
+        "seconds": round(elapsed, 3),
+        "lines_per_second": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            name: round(percentile(latencies, p) * 1000, 3)
+            for name, p in (("p50", 50), ("p90", 90), ("p99", 99), ("p999", 99.9))
+        },
+        "latency_max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+        "pipe_full_stalls": sum(w.stalls for w in writers),
+        "pipe_full_seconds": round(sum(w.stalled for w in writers), 3),
+        "rss_kib": {
+            "start": rss[0] if rss else None,
+            "max": max(rss) if rss else None,
+            "end": rss[-1] if rss else None,
+        },
+        "rss_samples": sampler.samples,
+        "exit_status": child.returncode,
+    }
+
+
+def print_result(number, result):
+    latency = result["latency_ms"]
+    rss = result["rss_kib"]
+    print(
+        "run {}: {} of {} lines in {} s, {} lines/s".format(
+            number,
+            result["received"],
+            result["sent"],
+            result["seconds"],
+            result["lines_per_second"],
+        )
+    )
+    print(
+        "  latency ms: p50 {p50} p90 {p90} p99 {p99} p99.9 {p999} max {}".format(
+            result["latency_max_ms"], **latency
+        )
+    )
+    print(
+        "  pipe full: {} stalls, {} s".format(
+            result["pipe_full_stalls"], result["pipe_full_seconds"]
+        )
+    )
+    print(
+        "  RSS KiB: start {} max {} end {}".format(rss["start"], rss["max"], rss["end"])
+    )
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in LINE_KINDS:
+            raise argparse.ArgumentTypeError(
+                "unknown line kind {!r}, choose from {}".format(
+                    kind, ", ".join(sorted(LINE_KINDS))
+                )
+            )
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0],
+        epilog="Options after -- are passed to anonip.",
+    )
+    parser.add_argument(
+        "--writers", type=int, default=32, help="concurrent writers (default: 32)"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=200,
+        help="lines per second of each writer, 0 for as fast as possible "
+        "(default: 200)",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="seconds to write (default: 10)"
+    )
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default="combined=8,common=1,long=1",
+        help="weights of the line kinds {} (default: %(default)s)".format(
+            ", ".join(sorted(LINE_KINDS))
+        ),
+    )
+    parser.add_argument(
+        "--seed", type=int, default=42, help="seed of the lines (default: 42)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="number of runs (default: 1)"
+    )
+    parser.add_argument(
+        "--startup",
+        type=float,
+        default=0.5,
+        help="seconds to wait for anonip to start (default: 0.5)",
+    )
+    parser.add_argument(
+        "--rss-interval",
+        type=float,
+        default=0.5,
+        help="seconds between RSS samples (default: 0.5)",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    parser.add_argument("anonip_args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+    if args.anonip_args[:1] == ["--"]:
+        args.anonip_args = args.anonip_args[1:]
+    return args
+
+
+def main():
+    args = parse_arguments(sys.argv[1:])
+    results = []
+    for number in range(1, args.repeat + 1):
+        result = run_load(args, args.seed)
+        results.append(result)
+        if not args.json:
+            print_result(number, result)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif len(results) > 1:
+        rates = sorted(r["lines_per_second"] for r in results)
+        p99 = sorted(r["latency_ms"]["p99"] for r in results)
+        print(
+            "median of {} runs: {} lines/s, latency p99 {} ms".format(
+                len(results), rates[len(rates) // 2], p99[len(p99) // 2]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
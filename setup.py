@@ -33,6 +33,7 @@ setup(
         "Programming Language :: Python :: Implementation :: PyPy",
     ],
     install_requires=['ipaddress; python_version<"3.3"'],
+    extras_require={"numpy": ["numpy"]},
     py_modules=["anonip"],
     entry_points={"console_scripts": ["anonip = anonip:main"]},
 )
@@ -9,9 +9,15 @@ Tests for anonip.
 from __future__ import print_function, unicode_literals
 
 import argparse
+import errno
 import logging
+import os
 import re
+import signal
+import socket
+import subprocess
 import sys
+import time
 from io import StringIO
 
 import pytest
@@ -219,12 +225,46 @@ def test_run_with_input_file():
     assert lines == ["192.168.96.0", "1.2.0.0", "", "9.8.128.0"]
 
 
+class RecordingStringIO(StringIO):
+    """
+    StringIO remembering the largest size passed to readline().
+    """
+
+    max_size = 0
+
+    def readline(self, size=-1):
+        self.max_size = max(self.max_size, size)
+        return super(RecordingStringIO, self).readline(size)
+
+
+def test_run_with_max_line_length():
+    a = anonip.Anonip(max_line_length=20)
+
+    input_file = RecordingStringIO(
+        "192.168.100.200 " + "x" * 1000 + "\n"
+        "1.2.3.4 " + "x" * 12 + "\n"
+        "1.2.3.4 " + "x" * 13 + "\n"
+        "9.8.130.6 " + "x" * 30
+    )
+
+    lines = [line for line in a.run(input_file)]
+    assert lines == [
+        "192.168.96.0 xxxx",
+        "1.2.0.0 xxxxxxxxxxxx",
+        "1.2.0.0 xxxxxxxxxxxx",
+        "9.8.128.0 xxxxxxxxxx",
+    ]
+    assert input_file.max_size == 21
+
+
 @pytest.mark.parametrize(
     "args,attribute,expected",
     [
         (["-c", "3", "5"], "columns", [3, 5]),
         (["-4", "24"], "ipv4mask", 24),
         (["-6", "64"], "ipv6mask", 64),
+        (["--max-line-length", "8192"], "max_line_length", 8192),
+        ([], "max_line_length", None),
     ],
 )
 def test_cli_generic_args(args, attribute, expected):
@@ -255,13 +295,13 @@ def test_cli_args_ambiguity(args, success):
 @pytest.mark.parametrize(
     "args,expected",
     [
-        (["--regex", "test"], "test"),
-        (["--regex", "foo", "bar", "baz"], "foo|bar|baz"),
+        (["--regex", "test"], ["test"]),
+        (["--regex", "foo", "bar", "baz"], ["foo", "bar", "baz"]),
     ],
 )
-def test_regex_concat(args, expected):
+def test_regex_list(args, expected):
     args = anonip.parse_arguments(args)
-    assert args.regex == re.compile(expected)
+    assert args.regex == expected
 
 
 @pytest.mark.parametrize(
@@ -411,3 +451,1350 @@ def test_properties_columns():
     assert a.columns == [0]
     a.columns = [5, 6]
     assert a.columns == [4, 5]
+
+
+ARRAY_IPV4 = [
+    "192.168.100.200",
+    "1.2.3.4",
+    "9.8.130.6",
+    "10.11.12.13",
+    "255.255.255.255",
+    "0.0.0.1",
+    "203.0.113.77",
+]
+ARRAY_IPV6 = [
+    "2001:0db8:85a3:0000:0000:8a2e:0370:7334",
+    "2a00:1450:400a:803::200e",
+    "::ffff:8.8.8.8",
+    "::ffff:192.168.1.1",
+    "fe80::822a:a8ff:fe49:470c",
+    "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff",
+    "::1",
+]
+
+
+def _scalar_results(a, addresses):
+    return [
+        int(a.process_ip(anonip.ipaddress.ip_network(address))) for address in addresses
+    ]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"ipv4mask": 32, "ipv6mask": 128},
+        {"ipv4mask": 0, "ipv6mask": 0},
+        {"ipv4mask": 24, "ipv6mask": 64, "increment": 3},
+        {"increment": 1 << 70},
+        {"increment": 1 << 130},
+        {"ipv6mask": 1, "increment": 2},
+        {"skip_private": True},
+        {"skip_private": True, "increment": 2},
+        {"pseudonymize_key": b"secret"},
+        {"pseudonymize_key": b"secret", "skip_private": True, "increment": 2},
+    ],
+)
+def test_process_ip_arrays(kwargs):
+    np = pytest.importorskip("numpy")
+    a = anonip.Anonip(**kwargs)
+
+    packed = [int(anonip.ipaddress.ip_address(ip)) for ip in ARRAY_IPV4]
+    result = a.process_ipv4_array(np.array(packed, dtype=np.uint32))
+    assert result.dtype == np.uint32
+    assert [int(r) for r in result] == _scalar_results(a, ARRAY_IPV4)
+
+    packed = [int(anonip.ipaddress.ip_address(ip)) for ip in ARRAY_IPV6]
+    high, low = a.process_ipv6_array(
+        np.array([p >> 64 for p in packed], dtype=np.uint64),
+        np.array([p & 0xFFFFFFFFFFFFFFFF for p in packed], dtype=np.uint64),
+    )
+    assert high.dtype == low.dtype == np.uint64
+    assert [
+        int(upper) << 64 | int(lower) for upper, lower in zip(high, low)
+    ] == _scalar_results(a, ARRAY_IPV6)
+
+
+def test_process_ip_arrays_pseudonymize():
+    np = pytest.importorskip("numpy")
+    a = anonip.Anonip(pseudonymize_key=b"secret")
+    pseudonymize_address = a.pseudonymize_address
+    calls = []
+
+    def counting_pseudonymize_address(ip):
+        calls.append(ip)
+        return pseudonymize_address(ip)
+
+    a.pseudonymize_address = counting_pseudonymize_address
+    # each distinct address is pseudonymized once, the shape is kept
+    addresses = np.array([[16909060, 16909061], [16909060, 16909060]], np.uint32)
+    result = a.process_ipv4_array(addresses)
+    assert result.shape == (2, 2)
+    assert result[0, 0] == result[1, 0] == result[1, 1] != result[0, 1]
+    ip = anonip.ipaddress.ip_network("1.2.3.4")
+    assert int(result[0, 0]) == int(a.process_ip(ip))
+    assert len(calls) == 3
+
+    high = np.array([0x20010DB800000000] * 3, np.uint64)
+    low = np.array([1, 2, 1], np.uint64)
+    result_high, result_low = a.process_ipv6_array(high, low)
+    assert (result_high[0], result_low[0]) == (result_high[2], result_low[2])
+    assert (result_high[0], result_low[0]) != (result_high[1], result_low[1])
+    assert len(calls) == 5
+
+    empty = a.process_ipv4_array(np.array([], np.uint32))
+    assert empty.dtype == np.uint32 and empty.shape == (0,)
+    empty = a.process_ipv6_array(np.array([], np.uint64), np.array([], np.uint64))
+    assert empty[0].shape == empty[1].shape == (0,)
+
+
+def test_process_ip_arrays_without_numpy(monkeypatch):
+    monkeypatch.setitem(sys.modules, "numpy", None)
+    a = anonip.Anonip()
+    with pytest.raises(ImportError):
+        a.process_ipv4_array([1, 2, 3])
+
+
+# Modules only needed by some modes; they must not be imported at startup.
+DEFERRED_IMPORTS = {
+    "argparse",
+    "urllib.parse",
+    "numpy",
+    "hmac",
+    "queue",
+    "tempfile",
+    "multiprocessing",
+    "json",
+    "socket",
+}
+
+
+# Maximum time in µs the imports for processing lines may take, besides those
+# of the interpreter's startup. Importing numpy alone takes about as long.
+IMPORT_TIME_BUDGET = 100000
+
+
+def _import_times(args, stdin=""):
+    """
+    Run python with "-X importtime".
+
+    Returns the output and the imported modules as tuples (name, nesting
+    level, cumulative µs).
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-X", "importtime"] + args,
+        cwd=os.path.dirname(os.path.abspath(anonip.__file__)),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    out, err = process.communicate(stdin)
+    assert process.returncode == 0, err
+    imports = []
+    for line in err.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            level = (len(name) - len(name.lstrip()) - 1) // 2
+            if cumulative.strip().isdigit():
+                imports.append((name.strip(), level, int(cumulative)))
+    return out, imports
+
+
+def _imported_modules(args, stdin=""):
+    """
+    Run python with "-X importtime" and return the modules it imported.
+    """
+    out, imports = _import_times(args, stdin)
+    return out, set(name for name, _, _ in imports)
+
+
+def _import_time(args, stdin=""):
+    """
+    Time in µs of the imports besides those of the interpreter's startup,
+    the best of three runs.
+    """
+    _, startup = _imported_modules(["-c", "pass"])
+    times = []
+    for _ in range(3):
+        _, imports = _import_times(args, stdin)
+        times.append(
+            sum(
+                cumulative
+                for name, level, cumulative in imports
+                if level == 0 and name not in startup
+            )
+        )
+    return min(times)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="needs -X importtime")
+def test_import_time_library():
+    _, modules = _imported_modules(["-c", "import anonip"])
+    assert not modules & DEFERRED_IMPORTS
+    assert _import_time(["-c", "import anonip"]) < IMPORT_TIME_BUDGET
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="needs -X importtime")
+def test_import_time_cli():
+    out, modules = _imported_modules(["anonip.py"], "192.168.100.200 foo\n")
+    assert out == "192.168.96.0 foo\n"
+    assert not modules & (DEFERRED_IMPORTS - {"argparse"})
+    assert _import_time(["anonip.py"], "192.168.100.200 foo\n") < IMPORT_TIME_BUDGET
+
+
+class StalledOutput(StringIO):
+    """
+    StringIO whose first write blocks until `release` is set.
+    """
+
+    def __init__(self):
+        import threading
+
+        super(StalledOutput, self).__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, data):
+        self.entered.set()
+        self.release.wait()
+        return super(StalledOutput, self).write(data)
+
+
+@pytest.mark.parametrize(
+    "policy,spilled,dropped,expected",
+    [
+        ("spill", 7, 0, [str(i) for i in range(11)]),
+        ("drop", 0, 7, ["0", "1", "2", "10"]),
+    ],
+)
+def test_queued_writer_full(policy, spilled, dropped, expected):
+    output = StalledOutput()
+    writer = anonip._QueuedWriter(output, 2, policy)
+    writer.write_line("0")
+    assert output.entered.wait(5)
+    for i in range(1, 10):
+        writer.write_line(str(i))
+    assert writer.depth == 2
+    output.release.set()
+    # wait until the writer took all queued and spilled lines
+    while writer.depth or writer._spill_file:
+        time.sleep(0.001)
+    writer.write_line("10")
+    writer.close()
+
+    assert output.getvalue().split("\n")[:-1] == expected
+    assert writer.max_depth == 2
+    assert writer.spilled == spilled
+    assert writer.dropped == dropped
+
+
+def test_queued_writer_spill_race():
+    output = StringIO()
+    writer = anonip._QueuedWriter(output, 2, "spill")
+    put_nowait = writer._queue.put_nowait
+    calls = []
+
+    def racing_put_nowait(line):
+        calls.append(line)
+        if len(calls) == 1:
+            # the queue was full, but the writer emptied it before the lock
+            # got acquired
+            raise writer._queue_full
+        put_nowait(line)
+
+    writer._queue.put_nowait = racing_put_nowait
+    writer.write_line("1")
+    writer.write_line("2")
+    for _ in range(5000):
+        if output.getvalue() == "1\n2\n":
+            break
+        time.sleep(0.001)
+    assert output.getvalue() == "1\n2\n"
+    assert writer.spilled == 0
+    writer.close()
+
+
+def test_queued_writer_unspill_race(monkeypatch):
+    unspill = anonip._QueuedWriter._unspill
+    racing = []
+
+    def racing_unspill(self):
+        if not racing:
+            # the writer found the queue empty, then the producer refilled it
+            # and spilled before the writer took the spill file
+            racing.append(True)
+            for i in range(3):
+                self.write_line(str(i))
+        unspill(self)
+
+    monkeypatch.setattr(anonip._QueuedWriter, "_unspill", racing_unspill)
+    output = StringIO()
+    writer = anonip._QueuedWriter(output, 2, "spill", batch_size=1)
+    while not racing:
+        time.sleep(0.001)
+    writer.write_line("3")
+    writer.close()
+    assert output.getvalue() == "0\n1\n2\n3\n"
+    assert writer.spilled == 2
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGUSR1"), reason="needs SIGUSR1")
+def test_queued_writer_stats_on_signal(caplog):
+    output = StalledOutput()
+    writer = anonip._QueuedWriter(output, 2, "drop")
+    previous = anonip._log_stats_on_signal(writer)
+    try:
+        writer.write_line("0")
+        assert output.entered.wait(5)
+        for i in range(1, 4):
+            writer.write_line(str(i))
+        os.kill(os.getpid(), signal.SIGUSR1)
+        # the handler runs in the main thread before the next instruction
+        assert "Writer queue: depth 2, maximum depth 2" in caplog.text
+        assert "1 lines dropped" in caplog.text
+    finally:
+        signal.signal(signal.SIGUSR1, previous[signal.SIGUSR1])
+        output.release.set()
+        writer.close()
+
+
+def test_queued_writer_error():
+    class BrokenOutput(StringIO):
+        def write(self, data):
+            raise IOError("disk full")
+
+    writer = anonip._QueuedWriter(BrokenOutput(), 1)
+    writer.write_line("1.2.0.0")
+    while not writer._error:
+        time.sleep(0.001)
+    with pytest.raises(IOError):
+        writer.write_line("1.2.0.0")
+    with pytest.raises(IOError):
+        writer.close()
+
+
+@pytest.mark.parametrize("policy", ["block", "spill", "drop"])
+def test_main_writer_queue(policy, tmp_path, capsys, backup_and_restore_sys_argv):
+    input_filename = tmp_path / "anonip-input.txt"
+    input_filename.write_text("".join("1.2.3.{} string\n".format(i) for i in range(50)))
+    sys.argv = [
+        "anonip.py",
+        "--input",
+        str(input_filename),
+        "--writer-queue",
+        "1000",
+        "--queue-full",
+        policy,
+    ]
+    anonip.main()
+    captured = capsys.readouterr()
+    assert captured.out == "1.2.0.0 string\n" * 50
+    if hasattr(signal, "SIGUSR1"):  # pragma: no branch
+        assert signal.getsignal(signal.SIGUSR1) == signal.SIG_DFL
+
+
+@pytest.mark.parametrize(
+    "log_format,line,expected",
+    [
+        (
+            "combined",
+            '192.168.100.200 - - [20/May/2015:21:05:01 +0000] "GET / HTTP/1.1" '
+            '200 13358 "-" "useragent"',
+            '192.168.96.0 - - [20/May/2015:21:05:01 +0000] "GET / HTTP/1.1" '
+            '200 13358 "-" "useragent"',
+        ),
+        (
+            '%t "%r" %>s "%{X-Forwarded-For}i" %a',
+            r'[20/May/2015:21:05:01 +0000] "GET /?\"1.2.3.4\" x\\" 200 '
+            r'"1.2.3.4, 2001:db8:1::ab9:C0A8:102 , unknown" 5.6.7.8:80',
+            r'[20/May/2015:21:05:01 +0000] "GET /?\"1.2.3.4\" x\\" 200 '
+            r'"1.2.0.0, 2001:db8:: , unknown" 5.6.0.0:80',
+        ),
+        (
+            '$remote_addr - $remote_user [$time_local] "$request" 100%% $status',
+            '1.2.3.4 - - [20/May/2015:21:05:01 +0000] "GET / HTTP/1.1" 100% 200',
+            '1.2.0.0 - - [20/May/2015:21:05:01 +0000] "GET / HTTP/1.1" 100% 200',
+        ),
+        ("%u %h", "- 1.2.3.4", "- 1.2.0.0"),
+        ("%u %h", "- -", "- -"),
+        ("%u %h", "-", "-"),
+        ("%u %h", "a b", "a b"),
+        (
+            "%a [%{%d/%b/%Y %T}t] %h",
+            "1.2.3.4 [10/Oct/2000 13:55:36] 5.6.7.8",
+            "1.2.0.0 [10/Oct/2000 13:55:36] 5.6.0.0",
+        ),
+        ("[%h]", "1.2.3.4", "1.2.3.4"),
+        ('"%r" %h', '"GET / 1.2.3.4', '"GET / 1.2.3.4'),
+        (
+            "[%h] %t %a",
+            "[1.2.3.4] [20/May/2015:21:05:01 +0000",
+            "[1.2.3.4] [20/May/2015:21:05:01 +0000",
+        ),
+        (
+            "%t %a",
+            "[20/May/2015:21:05:01 +0000] 1.2.3.4",
+            "[20/May/2015:21:05:01 +0000] 1.2.0.0",
+        ),
+    ],
+)
+def test_log_format(log_format, line, expected):
+    a = anonip.Anonip(log_format=log_format)
+    assert a.process_line(line) == expected
+
+
+def test_log_format_replace():
+    a = anonip.Anonip(log_format="common", replace="0.0.0.0")
+    line = 'example.com - - [20/May/2015:21:05:01 +0000] "GET / HTTP/1.1" 200 13358'
+    assert a.process_line(line) == line.replace("example.com", "0.0.0.0")
+
+
+def test_log_format_cache():
+    parser = anonip.compile_log_format("combined")
+    assert anonip.compile_log_format("combined") is parser
+    a = anonip.Anonip(log_format="combined")
+    assert a.log_format == "combined"
+    assert a._log_format_parser is parser
+
+
+@pytest.mark.parametrize(
+    "value,valid",
+    [
+        ("common", True),
+        ("%h%u x", False),
+        ("%u %t", False),
+        # fields which can hold the separator shift the fields after them
+        ("%a %{%d/%b/%Y %T}t %h", False),
+        ("%r %h", False),
+        ("%h %{X-Forwarded-For}i %a", False),
+        ("$time_local $remote_addr", False),
+        ("$http_user_agent|$remote_addr", False),
+        ("%a [%{%d/%b/%Y %T}t] %h", True),
+        ('"%{User-agent}i" $remote_addr', True),
+        ("%h %u %>s %b %a", True),
+    ],
+)
+def test_log_format_arg_type(value, valid):
+    if valid:
+        assert anonip.log_format_arg_type(value) == value
+    else:
+        with pytest.raises(argparse.ArgumentTypeError):
+            anonip.log_format_arg_type(value)
+
+
+@pytest.mark.parametrize(
+    "args,success",
+    [
+        (["--log-format", "common"], True),
+        (["--log-format", "common", "-c", "3"], False),
+        (["--log-format", "common", "-l", ";"], False),
+        (["--log-format", "common", "--regex", "test"], False),
+    ],
+)
+def test_cli_log_format_ambiguity(args, success):
+    if success:
+        assert anonip.parse_arguments(args).log_format == "common"
+        return
+
+    with pytest.raises(SystemExit) as e:
+        anonip.parse_arguments(args)
+    assert e.value.code == 2
+
+
+def test_main_log_format(tmp_path, capsys, backup_and_restore_sys_argv):
+    input_filename = tmp_path / "anonip-input.txt"
+    input_filename.write_text(
+        "2001:0db8:85a3:0000:0000:8a2e:0370:7334 - - [20/May/2015:21:05:01 +0000] "
+        '"GET / HTTP/1.1" 200 13358\n'
+    )
+    sys.argv = ["anonip.py", "--input", str(input_filename), "--log-format", "common"]
+    anonip.main()
+    captured = capsys.readouterr()
+    assert captured.out == (
+        '2001:db8:85a0:: - - [20/May/2015:21:05:01 +0000] "GET / HTTP/1.1" 200 13358\n'
+    )
+
+
+def test_pseudonymize():
+    a = anonip.Anonip(pseudonymize_key=b"secret")
+    assert a.pseudonymize_key == b"secret"
+    line = a.process_line("1.2.3.4:80 x")
+    ip4 = anonip.ipaddress.ip_address(line.split(":")[0])
+    assert ip4 in anonip.PSEUDONYM_NETWORKS[4]
+    assert a.process_line("1.2.3.4:80 x") == line
+    assert a.process_line("1.2.3.5:80 x") != line
+    ip6 = anonip.ipaddress.ip_address(a.process_line("2001:db8:1::ab9:C0A8:102"))
+    assert ip6 in anonip.PSEUDONYM_NETWORKS[6]
+    assert len(a._pseudonym_cache) == 3
+
+    a.pseudonymize_key = b"other secret"
+    assert a.process_line("1.2.3.4:80 x") != line
+    assert len(a._pseudonym_cache) == 1
+
+
+def test_pseudonymize_skip_private():
+    a = anonip.Anonip(pseudonymize_key=b"secret", skip_private=True)
+    assert a.process_line("192.168.100.200") == "192.168.100.200"
+
+
+def test_pseudonymize_key_rotation(monkeypatch):
+    now = [86400 * 20000 + 10]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    a = anonip.Anonip(pseudonymize_key=b"secret", key_rotation="daily")
+    static = anonip.Anonip(pseudonymize_key=b"secret")
+
+    first = a.process_line("1.2.3.4")
+    assert first != static.process_line("1.2.3.4")
+    now[0] += 3600
+    assert a.process_line("1.2.3.4") == first
+    now[0] += 86400
+    second = a.process_line("1.2.3.4")
+    assert second != first
+    assert len(a._pseudonym_cache) == 1
+
+    a.key_rotation = None
+    assert a.process_line("1.2.3.4") == static.process_line("1.2.3.4")
+
+
+def test_lru_cache():
+    cache = anonip._LRUCache(2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache.get("a") == 1
+    cache["c"] = 3
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+    cache = anonip._LRUCache(0)
+    cache["a"] = 1
+    assert cache.get("a") is None
+
+
+def test_read_key_file(tmp_path):
+    key_file = tmp_path / "key"
+    key_file.write_bytes(b"secret\n")
+    assert anonip._read_key_file(str(key_file)) == b"secret\n"
+    key_file.write_bytes(b"")
+    with pytest.raises(argparse.ArgumentTypeError):
+        anonip._read_key_file(str(key_file))
+    with pytest.raises(argparse.ArgumentTypeError):
+        anonip._read_key_file(str(tmp_path / "missing"))
+
+
+@pytest.mark.parametrize("rotation", ["none", "daily"])
+def test_main_pseudonymize(rotation, tmp_path, capsys, backup_and_restore_sys_argv):
+    key_file = tmp_path / "key"
+    key_file.write_bytes(b"secret")
+    input_filename = tmp_path / "anonip-input.txt"
+    input_filename.write_text("1.2.3.4 a\n1.2.3.4 b\n")
+    sys.argv = [
+        "anonip.py",
+        "--input",
+        str(input_filename),
+        "--pseudonymize",
+        str(key_file),
+        "--key-rotation",
+        rotation,
+        "--pseudonym-cache",
+        "10",
+    ]
+    anonip.main()
+    lines = capsys.readouterr().out.split("\n")
+    first, second = lines[0].split(" "), lines[1].split(" ")
+    assert first[0] == second[0]
+    assert anonip.ipaddress.ip_address(first[0]) in anonip.PSEUDONYM_NETWORKS[4]
+
+
+@pytest.mark.parametrize(
+    "kwargs,line,expected",
+    [
+        ({"columns": [1, 3, 9]}, "1.2.3.4 2.3.4.5 foo", ["1.2.3.4"]),
+        (
+            {"regex": re.compile(r"^(\S+) (\S+) (x)?")},
+            "1.2.3.4:80 1.2.3.4:80 y",
+            ["1.2.3.4"],
+        ),
+        (
+            {"log_format": '%h "%{X-Forwarded-For}i" %u'},
+            '1.2.3.4 "5.6.7.8, -, foo" x',
+            ["1.2.3.4", "5.6.7.8"],
+        ),
+        ({"log_format": "[%h]"}, "1.2.3.4", []),
+    ],
+)
+def test_iter_addresses(kwargs, line, expected):
+    a = anonip.Anonip(**kwargs)
+    assert [ip_str for ip_str, ip in a.iter_addresses(line)] == expected
+
+
+@pytest.mark.parametrize(
+    "kwargs,ip,expected",
+    [
+        ({}, "1.2.0.0", True),
+        ({}, "1.2.3.4", False),
+        ({}, "2001:db8:85a0::", True),
+        ({}, "2001:db8:85a0::1", False),
+        ({"increment": 1}, "1.2.0.1", True),
+        ({"increment": 1}, "1.2.0.0", False),
+        ({"skip_private": True}, "192.168.100.200", True),
+        ({"pseudonymize_key": b"secret"}, "240.1.2.3", True),
+        ({"pseudonymize_key": b"secret"}, "1.2.0.0", False),
+    ],
+)
+def test_is_anonymized(kwargs, ip, expected):
+    a = anonip.Anonip(**kwargs)
+    assert a.is_anonymized(anonip.ipaddress.ip_network(ip)) == expected
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_audit(jobs, tmp_path):
+    import gzip
+
+    clean = tmp_path / "clean.log"
+    clean.write_text("1.2.0.0 a\n\n2001:db8:85a0:: b\nfoo c\n")
+    dirty = tmp_path / "dirty.log"
+    dirty.write_text("".join("1.2.{}.0 x\n".format(i) for i in range(20)))
+    missing = tmp_path / "missing.log"
+    truncated = tmp_path / "truncated.log.gz"
+    data = gzip.compress(b"1.2.0.0 y\n" * 1000)
+    truncated.write_bytes(data[: len(data) // 2])
+    output = StringIO()
+
+    paths = [str(clean), str(missing), str(truncated), str(dirty)]
+    unmasked, failed = anonip.audit(paths, {}, jobs, output)
+
+    assert (unmasked, failed) == (18, 2)
+    report = output.getvalue().split("\n")
+    assert report[0] == "{}: 4 lines, 2 addresses, 0 not anonymized".format(clean)
+    assert report[1].startswith(
+        "{}: 0 lines, 0 addresses, 0 not anonymized, failed: ".format(missing)
+    )
+    assert "No such file" in report[1]
+    assert re.match(
+        re.escape(str(truncated)) + r": \d+ lines, \d+ addresses, 0 not anonymized, "
+        "failed: Compressed file ended",
+        report[2],
+    )
+    assert report[3] == "{}: 20 lines, 20 addresses, 18 not anonymized".format(dirty)
+    assert report[4] == "  {}:2: 1.2.1.0".format(dirty)
+    assert report[13] == "  {}:11: 1.2.10.0".format(dirty)
+    assert report[14] == ""
+
+
+@pytest.mark.parametrize("content,status", [("1.2.0.0\n", 0), ("1.2.3.4\n", 1)])
+def test_main_audit(content, status, tmp_path, capsys, backup_and_restore_sys_argv):
+    log_file = tmp_path / "anonip.log"
+    log_file.write_text(content)
+    sys.argv = ["anonip.py", "--audit", str(log_file), "-j", "1"]
+    assert anonip.main() == status
+    assert capsys.readouterr().out.startswith(str(log_file))
+    assert log_file.read_text() == content
+
+    # a file which can't be read fails the audit, too
+    sys.argv[2:3] = [str(log_file), str(tmp_path / "missing.log")]
+    assert anonip.main() == 1
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_main_recursive(jobs, tmp_path, backup_and_restore_sys_argv):
+    import bz2
+    import gzip
+
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "access.log").write_text("1.2.3.4 a\n1.2.3.5 b\n")
+    (tmp_path / "done.log").write_text("1.2.3.4 c\n")
+    (tmp_path / "broken.log").write_bytes(b"1.2.3.4 \xff\xfe\n")
+    (tmp_path / "link.log").symlink_to(tmp_path / "access.log")
+    with gzip.open(str(tmp_path / "sub" / "access.log.1.gz"), "wt") as f:
+        f.write("2001:0db8:85a3:0000:0000:8a2e:0370:7334 d\n")
+    with bz2.open(str(tmp_path / "sub" / "access.log.2.bz2"), "wt") as f:
+        f.write("9.8.130.6 e\n")
+    # a truncated gzip file
+    data = gzip.compress(b"1.2.3.4 f\n" * 100)
+    (tmp_path / "sub" / "access.log.3.gz").write_bytes(data[: len(data) // 2])
+    (tmp_path / anonip.MANIFEST_NAME).write_text("done.log\n")
+    os.utime(str(tmp_path / "access.log"), (1000000000, 1000000000))
+
+    sys.argv = ["anonip.py", "--recursive", str(tmp_path), "-j", jobs]
+    assert anonip.main() == 1
+
+    assert (tmp_path / "access.log").read_text() == "1.2.0.0 a\n1.2.0.0 b\n"
+    assert os.stat(str(tmp_path / "access.log")).st_mtime == 1000000000
+    assert (tmp_path / "done.log").read_text() == "1.2.3.4 c\n"
+    assert (tmp_path / "broken.log").read_bytes() == b"1.2.3.4 \xff\xfe\n"
+    with gzip.open(str(tmp_path / "sub" / "access.log.1.gz"), "rt") as f:
+        assert f.read() == "2001:db8:85a0:: d\n"
+    with bz2.open(str(tmp_path / "sub" / "access.log.2.bz2"), "rt") as f:
+        assert f.read() == "9.8.128.0 e\n"
+    assert sorted(os.listdir(str(tmp_path))) == [
+        anonip.MANIFEST_NAME,
+        "access.log",
+        "broken.log",
+        "done.log",
+        "link.log",
+        "sub",
+    ]
+    assert sorted(os.listdir(str(tmp_path / "sub"))) == [
+        "access.log.1.gz",
+        "access.log.2.bz2",
+        "access.log.3.gz",
+    ]
+    assert (tmp_path / "sub" / "access.log.3.gz").read_bytes() == data[: len(data) // 2]
+    assert sorted((tmp_path / anonip.MANIFEST_NAME).read_text().split("\n")) == [
+        "",
+        "access.log",
+        "done.log",
+        os.path.join("sub", "access.log.1.gz"),
+        os.path.join("sub", "access.log.2.bz2"),
+    ]
+
+    # a second run finds nothing to do but the broken files
+    (tmp_path / "broken.log").unlink()
+    (tmp_path / "sub" / "access.log.3.gz").unlink()
+    assert anonip.main() == 0
+    assert (tmp_path / "access.log").read_text() == "1.2.0.0 a\n1.2.0.0 b\n"
+    # and removes the manifest, as all files are done
+    assert not (tmp_path / anonip.MANIFEST_NAME).exists()
+
+    # log rotation reuses the names
+    (tmp_path / "done.log").write_text("9.9.9.9 new\n")
+    assert anonip.main() == 0
+    assert (tmp_path / "done.log").read_text() == "9.9.0.0 new\n"
+    assert not (tmp_path / anonip.MANIFEST_NAME).exists()
+
+
+@pytest.mark.parametrize(
+    "args", [["--audit", "x"], ["--input", "x"], ["--output", "x"]]
+)
+def test_cli_recursive_ambiguity(args):
+    with pytest.raises(SystemExit) as e:
+        anonip.parse_arguments(["--recursive", "dir"] + args)
+    assert e.value.code == 2
+
+
+def test_rewrite_directory(tmp_path):
+    (tmp_path / "access.log").write_text("1.2.3.4 a\n")
+    assert anonip.rewrite_directory(str(tmp_path), {"ipv4mask": 8}, 1) == 0
+    assert (tmp_path / "access.log").read_text() == "1.2.3.0 a\n"
+    assert not (tmp_path / anonip.MANIFEST_NAME).exists()
+
+
+@pytest.mark.parametrize(
+    "content,parts,expected",
+    [
+        (b"", 4, [(0, 0)]),
+        (b"1.2.3.4\n" * 10, 1, [(0, 80)]),
+        (b"1.2.3.4\n" * 10, 3, [(0, 32), (32, 56), (56, 80)]),
+        (b"1.2.3.4\n" * 3, 8, [(0, 8), (8, 16), (16, 24)]),
+        (b"a" * 100000 + b"\nb\n", 4, [(0, 100001), (100001, 100003)]),
+        (b"a" * 100000, 4, [(0, 100000)]),
+    ],
+)
+def test_split_file(content, parts, expected, tmp_path):
+    path = tmp_path / "anonip-input.txt"
+    path.write_bytes(content)
+    assert anonip._split_file(str(path), parts) == expected
+
+
+@pytest.mark.parametrize(
+    "fail", [[], ["copy_file_range"], ["copy_file_range", "sendfile"]]
+)
+def test_copy_fd(fail, tmp_path, monkeypatch):
+    def broken(*args):
+        raise OSError("not supported")
+
+    for name in fail:
+        monkeypatch.setattr(os, name, broken, raising=False)
+    source = tmp_path / "source"
+    source.write_bytes(b"x" * 3000000)
+    target = tmp_path / "target"
+    target.write_bytes(b"abc")
+
+    in_fd = os.open(str(source), os.O_RDONLY)
+    out_fd = os.open(str(target), os.O_WRONLY)
+    os.lseek(out_fd, 0, os.SEEK_END)
+    anonip._copy_fd(in_fd, out_fd)
+    os.close(in_fd)
+    os.close(out_fd)
+    assert target.read_bytes() == b"abc" + b"x" * 3000000
+
+
+def test_main_split_input(tmp_path, capfd, backup_and_restore_sys_argv, monkeypatch):
+    part_dirs = []
+    map_files = anonip._map_files
+
+    def recording_map_files(func, tasks, kwargs, jobs):
+        part_dirs.extend(os.path.dirname(task[3]) for task in tasks)
+        return map_files(func, tasks, kwargs, jobs)
+
+    monkeypatch.setattr(anonip, "_map_files", recording_map_files)
+    input_filename = tmp_path / "anonip-input.txt"
+    lines = ["1.2.3.{} string öéäü".format(i) for i in range(200)] + ["", "  "]
+    input_filename.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    output_filename = tmp_path / "anonip-output.txt"
+    output_filename.write_text("existing\n")
+
+    sys.argv = ["anonip.py", "--input", str(input_filename), "-j", "3"]
+    assert anonip.main() == 0
+    expected = "1.2.0.0 string öéäü\n" * 200 + "\n\n"
+    assert capfd.readouterr().out == expected
+
+    sys.argv += ["--output", str(output_filename)]
+    del part_dirs[:]
+    assert anonip.main() == 0
+    assert output_filename.read_text(encoding="utf-8") == "existing\n" + expected
+    # the parts are created next to the output
+    assert len(set(part_dirs)) == 1
+    assert os.path.dirname(part_dirs[0]) == str(tmp_path)
+    assert sorted(os.listdir(str(tmp_path))) == [
+        "anonip-input.txt",
+        "anonip-output.txt",
+    ]
+
+
+def test_anonymize_range(tmp_path):
+    input_filename = tmp_path / "anonip-input.txt"
+    input_filename.write_bytes(b"1.2.3.4 a\n1.2.3.5 b\n1.2.3.6 c\n")
+    part = tmp_path / "part"
+    anonip._init_worker({"ipv4mask": 8})
+    task = (str(input_filename), 10, 20, str(part))
+    assert anonip._anonymize_range(task) == str(part)
+    assert part.read_text() == "1.2.3.0 b\n"
+
+
+@pytest.mark.parametrize(
+    "extra_args,path,expected",
+    [
+        ([], "anonip.log", True),
+        ([], "anonip.log.gz", False),
+        ([], "missing.log", False),
+        (["--writer-queue", "10"], "anonip.log", False),
+    ],
+)
+def test_can_split(extra_args, path, expected, tmp_path):
+    for name in ("anonip.log", "anonip.log.gz"):
+        (tmp_path / name).write_text("")
+    args = anonip.parse_arguments(["--input", str(tmp_path / path)] + extra_args)
+    assert anonip._can_split(args) == expected
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="needs python 3")
+def test_gzip_block_writer(tmp_path):
+    import gzip
+    import shutil
+
+    path = tmp_path / "anonip.log.gz"
+    lines = ["1.2.0.{} line {} öéäü".format(i % 256, i) for i in range(2000)]
+    with path.open("wb") as raw:
+        writer = anonip._GzipBlockWriter(raw, block_size=1000, threads=2)
+        for line in lines:
+            print(line, file=writer)
+            writer.flush()
+        writer.close()
+        writer.close()
+
+    expected = "".join(line + "\n" for line in lines)
+    data = path.read_bytes()
+    assert data.count(b"\x1f\x8b\x08") > 40
+    assert gzip.decompress(data).decode(writer._encoding) == expected
+    if shutil.which("zcat"):
+        output = subprocess.check_output(["zcat", str(path)])
+        assert output.decode(writer._encoding) == expected
+
+
+def test_gzip_block_writer_empty():
+    from io import BytesIO
+
+    raw = BytesIO()
+    anonip._GzipBlockWriter(raw, threads=1).close()
+    assert raw.getvalue() == b""
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="needs python 3")
+def test_main_gzip(tmp_path, capsysbinary, backup_and_restore_sys_argv):
+    import gzip
+
+    input_filename = tmp_path / "anonip-input.txt"
+    input_filename.write_text("1.2.3.4 string\n" * 100)
+    output_filename = tmp_path / "anonip.log.gz"
+    sys.argv = ["anonip.py", "--input", str(input_filename), "-z", "-j", "2"]
+    assert anonip.main() == 0
+    output = gzip.decompress(capsysbinary.readouterr().out)
+    assert output == b"1.2.0.0 string\n" * 100
+
+    sys.argv += ["--output", str(output_filename), "--gzip-block-size", "100"]
+    sys.argv += ["--gzip-threads", "2"]
+    assert anonip.main() == 0
+    assert anonip.main() == 0
+    output = gzip.decompress(output_filename.read_bytes())
+    assert output == b"1.2.0.0 string\n" * 200
+
+
+@pytest.mark.parametrize(
+    "line,expected",
+    [
+        ("client 1.2.3.4:80 said hi", "client 1.2.0.0:80 said hi"),
+        ("[2001:db8::1]:443 at 2015:21:05:01", "[2001:db8::]:443 at 2015:21:05:01"),
+        ("v1.2.3.4.5 :: fe80::1%eth0", "v1.2.3.4.5 :: fe80::%eth0"),
+        ("10.0.0.1,2.3.4.5 ::ffff:1.2.3.4", "10.0.0.0,2.3.0.0 ::"),
+        ("999.1.1.1 nothing", "999.1.1.1 nothing"),
+        ("Connection from 1.2.3.4.", "Connection from 1.2.0.0."),
+        ("client:1.2.3.4 denied", "client:1.2.0.0 denied"),
+        ("addr=1.2.3.4, next", "addr=1.2.0.0, next"),
+        ("peer 2001:db8::1.", "peer 2001:db8::."),
+        ("ip:2001:db8::5 y", "ip:2001:db8:: y"),
+        ("src=2001:db8::5", "src=2001:db8::"),
+    ],
+)
+def test_process_line_scan(line, expected):
+    a = anonip.Anonip(scan=True)
+    assert a.process_line(line) == expected
+    addresses = a.iter_addresses("a 1.2.3.4 b 999.1.1.1")
+    assert [text for text, _ in addresses] == ["1.2.3.4"]
+
+
+@pytest.mark.parametrize(
+    "lines,descriptions,expected",
+    [
+        (
+            ['1.2.3.4 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.0" 200 -'] * 5,
+            ["common log format", "space separated, columns 1"],
+            '1.2.0.0 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.0" 200 -',
+        ),
+        (
+            ['1.2.3.4 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.0" 200 1 "-" "x"']
+            * 5,
+            ["combined log format", "space separated, columns 1"],
+            '1.2.0.0 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.0" 200 1 "-" "x"',
+        ),
+        (
+            ['{"ts": "x", "ip": "1.2.3.4", "xff": "2001:db8::1", "n": 1}'] * 18
+            + ["[1]", "{broken"],
+            ["JSON lines, fields ip, xff"],
+            '{"ts": "x", "ip": "1.2.0.0", "xff": "2001:db8::", "n": 1}',
+        ),
+        (
+            ['{"ip": "1.2.3.4"}', '{"ip": "x"}'],
+            ["free text"],
+            '{"ip": "1.2.0.0"}',
+        ),
+        (["a;1.2.3.4;b"] * 5, ["semicolon separated, columns 2"], "a;1.2.0.0;b"),
+        (["1.2.3.4\tb\t::1"] * 5, ["tab separated, columns 1, 3"], "1.2.0.0\tb\t::"),
+        (["1.2.3.4", ""] * 5, ["space separated, columns 1"], "1.2.0.0"),
+        (["hi 1.2.3.4 x", "5.6.7.8", "none"], ["free text"], "hi 1.2.0.0 x"),
+        # engines missing addresses scanning finds aren't chosen
+        (
+            ["1.2.3.{} GET /x 5.6.7.8".format(i) for i in range(10)]
+            + ["1.2.3.4 GET /x"] * 10,
+            ["space separated, columns 1, 4"],
+            "1.2.0.0 GET /x 5.6.0.0",
+        ),
+        (
+            ["error from 9.9.9.9 boom"] * 5
+            + ["client 1.2.3.{} said hi".format(i) for i in range(95)],
+            ["space separated, columns 2, 3"],
+            "error from 9.9.0.0 boom",
+        ),
+        (
+            ["1.2.3.4;x 5.6.7.8"] * 10,
+            ["free text"],
+            "1.2.0.0;x 5.6.0.0",
+        ),
+        (
+            ['1.2.3.4 - - [10/Oct/2000:13:55:36 -0700] "GET /?5.6.7.8 HTTP/1.0" 200 -']
+            * 5,
+            ["free text"],
+            '1.2.0.0 - - [10/Oct/2000:13:55:36 -0700] "GET /?5.6.0.0 HTTP/1.0" 200 -',
+        ),
+        (
+            ['{"ip": "1.2.3.4"}'] * 9 + ['{"ip": "1.2.3.4", "xff": "::1"}'],
+            ["JSON lines, fields ip, xff"],
+            '{"ip": "1.2.0.0"}',
+        ),
+    ],
+)
+def test_autodetect(lines, descriptions, expected, caplog):
+    caplog.set_level(logging.INFO, logger="anonip")
+    a = anonip.Anonip()
+    description, rate = anonip.autodetect(a, [line + "\n" for line in lines])
+    assert description in descriptions
+    assert rate > 0
+    assert "Detected " + description in caplog.text
+    assert a.process_line(lines[0]) == expected
+
+
+def test_autodetect_tie(monkeypatch):
+    import itertools
+
+    ticks = itertools.count()
+    monkeypatch.setattr(anonip.time, "perf_counter", lambda: next(ticks), raising=False)
+    monkeypatch.setattr(anonip.time, "time", lambda: next(ticks))
+    a = anonip.Anonip()
+    # on a tie, the first engine found wins
+    line = '1.2.3.4 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.0" 200 -\n'
+    assert anonip.autodetect(a, [line]) == ("common log format", 1)
+
+
+def test_autodetect_empty(caplog):
+    caplog.set_level(logging.INFO, logger="anonip")
+    a = anonip.Anonip(columns=[2])
+    assert anonip.autodetect(a, ["\n", ""]) == (None, None)
+    assert a.columns == [1]
+    assert "No lines to detect" in caplog.text
+
+
+def test_prefixed_file():
+    from io import StringIO
+
+    f = anonip._PrefixedFile(["first\n", "second\n"], StringIO("third\n"))
+    assert f.readline(3) == "fir"
+    assert f.readline() == "st\n"
+    assert f.readline(100) == "second\n"
+    assert f.readline() == "third\n"
+    assert f.readline() == ""
+    f.close()
+
+
+def test_sample_input_timeout():
+    import threading
+
+    read_fd, write_fd = os.pipe()
+    input_file = open(read_fd, "r")
+    os.write(write_fd, b"a,1.2.3.4\nb,5.6.7.8\n")
+    a = anonip.Anonip()
+    start = time.time()
+    f = anonip._sample_input(a, input_file, 100, 0.2)
+    assert time.time() - start < 5
+    assert a.delimiter == ","
+    assert f.readline() == "a,1.2.3.4\n"
+    assert f.readline() == "b,5.6.7.8\n"
+
+    # lines arriving later are returned in order
+    threading.Timer(0.1, os.write, (write_fd, b"c,1.1.1.1\nd,2.2.2.2\n")).start()
+    assert f.readline() == "c,1.1.1.1\n"
+    assert f.readline() == "d,2.2.2.2\n"
+    os.close(write_fd)
+    assert f.readline() == ""
+    f.close()
+
+
+def test_main_auto(tmp_path, capsys, backup_and_restore_sys_argv):
+    input_filename = tmp_path / "anonip-input.txt"
+    lines = ["x,1.2.3.4,y\n"] * 3 + ["x,5.6.7.8,y\n"] * 5
+    input_filename.write_text("".join(lines))
+    sys.argv = ["anonip.py", "--input", str(input_filename), "--auto"]
+    sys.argv += ["--auto-sample", "3", "-j", "2"]
+    assert anonip.main() == 0
+    assert capsys.readouterr().out == "x,1.2.0.0,y\n" * 3 + "x,5.6.0.0,y\n" * 5
+
+    # the whole input fits into the sample
+    sys.argv = ["anonip.py", "--input", str(input_filename), "--auto"]
+    assert anonip.main() == 0
+    assert capsys.readouterr().out == "x,1.2.0.0,y\n" * 3 + "x,5.6.0.0,y\n" * 5
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["-c", "2"],
+        ["-l", ";"],
+        ["--regex", "(.*)"],
+        ["--log-format", "common"],
+        ["--audit", "file"],
+        ["--recursive", "dir"],
+    ],
+)
+def test_cli_auto_ambiguity(args):
+    with pytest.raises(SystemExit):
+        anonip.parse_arguments(["--auto"] + args)
+
+
+needs_unix_sockets = pytest.mark.skipif(
+    not hasattr(socket, "AF_UNIX"), reason="needs Unix sockets"
+)
+
+
+@needs_unix_sockets
+def test_syslog_writer_unix_datagram(tmp_path, caplog):
+    path = str(tmp_path / "log")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(path)
+    writer = anonip._SyslogWriter(path, tag="web", facility="local0", backoff=0)
+    writer.write("1.2.0.0 a\n1.2.0.0 ")
+    writer.flush()
+    writer.write("b\n")
+    writer.flush()
+    prefix = "<134>web[{}]: ".format(os.getpid()).encode()
+    assert server.recv(4096) == prefix + b"1.2.0.0 a"
+    assert server.recv(4096) == prefix + b"1.2.0.0 b"
+
+    # the daemon restarts
+    server.close()
+    os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(path)
+    writer.write("c\nd")
+    writer.close()
+    assert server.recv(4096) == prefix + b"c"
+    assert server.recv(4096) == prefix + b"d"
+    assert "retrying" in caplog.text
+    server.close()
+
+
+@needs_unix_sockets
+def test_syslog_writer_unix_stream(tmp_path):
+    path = str(tmp_path / "log")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    writer = anonip._SyslogWriter(path, max_size=1)
+    writer.write("1.2.0.0 a\n")
+    writer.write("1.2.0.0 b\n")
+    writer.close()
+    writer.close()
+    conn = server.accept()[0]
+    data = b"".join(iter(lambda: conn.recv(4096), b""))
+    prefix = "<14>anonip[{}]: ".format(os.getpid()).encode()
+    assert data == prefix + b"1.2.0.0 a\n" + prefix + b"1.2.0.0 b\n"
+    conn.close()
+    server.close()
+
+
+def test_syslog_writer_tcp():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    address = "tcp://127.0.0.1:{}".format(server.getsockname()[1])
+    writer = anonip._SyslogWriter(address)
+    writer.write("1.2.0.0 \xe4\n::\n")
+    writer.close()
+    conn = server.accept()[0]
+    data = b"".join(iter(lambda: conn.recv(4096), b""))
+    conn.close()
+    server.close()
+
+    messages = []
+    while data:
+        length, _, data = data.partition(b" ")
+        messages.append(data[: int(length)].decode("utf-8"))
+        data = data[int(length) :]
+    header = r"<14>1 \d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{6}Z \S+ anonip \d+ - - "
+    assert len(messages) == 2
+    assert re.match(header + "1.2.0.0 \xe4$", messages[0])
+    assert re.match(header + "::$", messages[1])
+
+
+@needs_unix_sockets
+def test_syslog_writer_message_too_long(tmp_path, caplog):
+    path = str(tmp_path / "log")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(path)
+    writer = anonip._SyslogWriter(path, retries=0)
+    writer.write("\xe4" * 200000 + "\n1.2.0.0\n")
+    writer.close()
+    prefix = "<14>anonip[{}]: ".format(os.getpid()).encode()
+    message = server.recv(65536)
+    assert len(message) <= anonip._SYSLOG_TRUNCATE_SIZE
+    assert message.decode("utf-8") == (
+        prefix + "\xe4".encode("utf-8") * ((2048 - len(prefix)) // 2)
+    ).decode("utf-8")
+    assert server.recv(65536) == prefix + b"1.2.0.0"
+    assert writer.truncated == 1
+    assert "too long" in caplog.text
+    server.close()
+
+
+@pytest.mark.parametrize(
+    "error,retried",
+    [
+        (OSError(errno.EINVAL, "Invalid argument"), False),
+        (socket.gaierror(socket.EAI_AGAIN, "Temporary failure"), True),
+    ],
+)
+def test_syslog_writer_errors(error, retried, tmp_path, caplog, monkeypatch):
+    writer = anonip._SyslogWriter(str(tmp_path / "log"), retries=1, backoff=0)
+
+    def connect():
+        raise error
+
+    monkeypatch.setattr(writer, "_connect", connect)
+    writer.write("1.2.0.0\n")
+    with pytest.raises(EnvironmentError):
+        writer.flush()
+    assert ("retrying" in caplog.text) == retried
+
+
+def test_syslog_writer_unavailable(tmp_path, caplog):
+    writer = anonip._SyslogWriter(str(tmp_path / "missing"), retries=2, backoff=0)
+    writer.write("1.2.0.0\n")
+    with pytest.raises(EnvironmentError):
+        writer.flush()
+    assert caplog.text.count("retrying") == 2
+
+
+@needs_unix_sockets
+def test_main_syslog(tmp_path, backup_and_restore_sys_argv):
+    path = str(tmp_path / "log")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(path)
+    input_filename = tmp_path / "anonip-input.txt"
+    input_filename.write_text("1.2.3.4 a\n5.6.7.8 b\n")
+    sys.argv = ["anonip.py", "--input", str(input_filename), "--syslog", path]
+    sys.argv += ["--syslog-tag", "apache", "--syslog-facility", "local7"]
+    assert anonip.main() == 0
+    prefix = "<190>apache[{}]: ".format(os.getpid()).encode()
+    assert server.recv(4096) == prefix + b"1.2.0.0 a"
+    assert server.recv(4096) == prefix + b"5.6.0.0 b"
+    server.close()
+
+
+@pytest.mark.parametrize(
+    "args", [["--output", "x"], ["-z"], ["--audit", "x"], ["--recursive", "x"]]
+)
+def test_cli_syslog_ambiguity(args):
+    with pytest.raises(SystemExit):
+        anonip.parse_arguments(["--syslog", "/dev/log"] + args)
+
+
+@pytest.mark.parametrize(
+    "regex,expected",
+    [
+        (r"^([^ ]+) - somefixedstring: ([^ ]+)", ("", " - somefixedstring: ")),
+        (r"blabla/ (\S+) /blu$", ("blabla/ ", "blabla/ ")),
+        (r"bla/ (\S+) /blublu$", ("bla/ ", " /blublu")),
+        (r"(?:client) \[(\S+)\]", ("client [", "client [")),
+        (r"(?P<x>ab)c|d", ("", "")),
+        (r"(?i)client (\S+)", ("", "")),
+        (r"(?i:client) (\S+) x", ("", " x")),
+        (r"\S+ (\S+)", ("", " ")),
+    ],
+)
+def test_regex_literals(regex, expected):
+    assert anonip._regex_literals(re.compile(regex)) == expected
+
+
+def test_regex_dispatcher():
+    dispatcher = anonip._RegexDispatcher(
+        [r"a (\S+)", re.compile(r"b (\S+)"), r".* x (\S+)", r"a (\S+) z"]
+    )
+    assert dispatcher.match("a 1 z").re.pattern == r"a (\S+)"
+    assert dispatcher.match("b 2").groups() == ("2",)
+    # the first regex matching wins, like with an alternation
+    assert dispatcher.match("b y x 3").re.pattern == r"b (\S+)"
+    assert dispatcher.match("c x 4").groups() == ("4",)
+    assert dispatcher.match("b") is None
+    assert dispatcher.match("a ") is None
+    assert dispatcher.match("") is None
+    assert anonip._RegexDispatcher(r"^(\S+)").match("1 2").groups() == ("1",)
+
+
+def test_main_regex_list(tmp_path, capsys, backup_and_restore_sys_argv):
+    input_filename = tmp_path / "anonip-input.txt"
+    input_filename.write_text(
+        "client 1.2.3.4 said hi\n5.6.7.8 - - x\nserver: 9.9.9.9 from 8.8.8.8\n"
+    )
+    sys.argv = ["anonip.py", "--input", str(input_filename), "--regex"]
+    sys.argv += [r"client (\S+)", r"server: (\S+) from (\S+)", r"(\S+) - - "]
+    assert anonip.main() == 0
+    assert capsys.readouterr().out == (
+        "client 1.2.0.0 said hi\n5.6.0.0 - - x\nserver: 9.9.0.0 from 8.8.0.0\n"
+    )
+
+
+def _wait_until_reading(process):
+    """
+    Wait until the process read all data written to its stdin and is waiting
+    for more.
+    """
+    import fcntl
+    import struct
+    import termios
+
+    for _ in range(10000):
+        pending = fcntl.ioctl(process.stdin.fileno(), termios.FIONREAD, b"\0" * 4)
+        with open("/proc/{}/stat".format(process.pid)) as f:
+            state = f.read().rsplit(")", 1)[1].split()[0]
+        if struct.unpack("i", pending)[0] == 0 and state == "S":
+            return
+        time.sleep(0.001)
+    raise AssertionError("the process didn't read its input")
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs /proc")
+def test_main_gzip_sigterm(tmp_path):
+    import gzip
+
+    output_filename = tmp_path / "anonip.log.gz"
+    process = subprocess.Popen(
+        [sys.executable, anonip.__file__, "-z", "-o", str(output_filename)],
+        stdin=subprocess.PIPE,
+    )
+    process.stdin.write(b"1.2.3.4 string\n")
+    process.stdin.flush()
+    # the line is held back in the gzip writer
+    _wait_until_reading(process)
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(10) == 128 + signal.SIGTERM
+    process.stdin.close()
+    assert gzip.decompress(output_filename.read_bytes()) == b"1.2.0.0 string\n"
+
+
+@pytest.mark.parametrize("gzip", [False, True])
+def test_main_sigterm_handler(gzip, tmp_path, monkeypatch, backup_and_restore_sys_argv):
+    handlers = []
+
+    def write_lines(anonip_, input_file, output_file, writer):
+        handlers.append(signal.getsignal(signal.SIGTERM))
+        raise SystemExit(128 + signal.SIGTERM)
+
+    exit_after = anonip._exit_after
+    deadlines = []
+
+    def recording_exit_after(timeout, status):
+        deadlines.append((status, exit_after(timeout, status)))
+        return deadlines[-1][1]
+
+    monkeypatch.setattr(anonip, "_write_lines", write_lines)
+    monkeypatch.setattr(anonip, "_exit_after", recording_exit_after)
+    sys.argv = ["anonip.py", "-o", str(tmp_path / "anonip.log")]
+    if gzip:
+        sys.argv.append("-z")
+    previous = signal.getsignal(signal.SIGTERM)
+    with pytest.raises(SystemExit):
+        anonip.main()
+
+    # the handler is only installed when lines are held back
+    assert (handlers[0] == anonip._terminate) == gzip
+    assert signal.getsignal(signal.SIGTERM) == previous
+    # the deadline for writing out the lines got cancelled once they were
+    [(status, timer)] = deadlines
+    assert status == 128 + signal.SIGTERM
+    timer.join(5)
+    assert not timer.is_alive()
+
+
+def test_terminate():
+    previous = signal.getsignal(signal.SIGTERM)
+    try:
+        with pytest.raises(SystemExit) as e:
+            anonip._terminate(signal.SIGTERM, None)
+        # another SIGTERM ends the process right away
+        assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+    assert e.value.code == 128 + signal.SIGTERM
+
+
+def test_exit_after(monkeypatch, caplog):
+    exits = []
+    monkeypatch.setattr(anonip.os, "_exit", exits.append)
+    anonip._exit_after(0, 143).join(5)
+    assert exits == [143]
+    assert "Could not write the buffered lines within 0 s." in caplog.text
+
+    timer = anonip._exit_after(5, 143)
+    timer.cancel()
+    timer.join(5)
+    assert exits == [143]